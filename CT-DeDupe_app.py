@@ -5,7 +5,14 @@ import numpy as np
 import re
 from file_convertor import *
 from concatenate_files import *
+from parse_cache import cached_concatenate_files
 from Import_data import *
+from unified_schema import STATUS_DTYPE, Unified_Records, Match_Keys, Title_Year_Candidates, Title_Year_Groups, Review_Clusters
+from trial_links import Link_Registry_Records
+from fuzzy_titles import Similar_Title_Candidates, SIMILARITY_THRESHOLD, YEAR_TOLERANCE
+from tfidf_similarity import TFIDF_Candidates, TFIDF_THRESHOLD
+from decision_log import (new_decision_log, record_batch, can_undo, can_redo, undo, redo, removed_ids, removed_mask,
+                          decisions_to_csv, read_decisions, replay_decisions)
 
 st.set_page_config(
     page_title="Clinical Trial Deduplicator",
@@ -39,9 +46,9 @@ with tab1:
     
     **Manual-Deduplication**: Based on all uploaded data, the tool identifies potential matches using Titles (Public Titles) and Years. In this tab, you can manually review these records to identify further duplicates. For each identified pair, you must consider one record as the 'Master' and mark the others as duplicates for removal. If no duplicates are found within a pair, the records can be left as they are. To simplify this process, the table pre-highlights one record in green and its potential duplicate in red. You need to select which records to remove from the collection. Once you have made your selections, click the 'Remove Checked Records' button below the table.
     
-    ⚠️ Note: Please review your selections carefully before clicking the 'Remove Checked Records' button. If a record is removed by mistake, you will need to refresh the tool and re-upload your data.
+    ⚠️ Note: Please review your selections carefully before clicking the 'Remove Checked Records' button. If a record is removed by mistake, click 'Undo'; 'Redo' applies it again. Under 'Decision Log' you can download your decisions as a CSV file and replay them later on the same data. Uploading a new file clears the decisions made so far.
     
-    **Export Data**: The Export Data tab provides a summary of your results, showing the total number of Master and Duplicate records for each source. From this section, you can download your cleaned data in both RIS and CSV formats for further use. The Master files contain all unique records after de-duplication. You can also download the duplicate records for each source in RIS and CSV formats.
+    **Export Data**: The Export Data tab provides a summary of your results, showing the total number of Master and Duplicate records for each source. From this section, you can download your cleaned data in both RIS and CSV formats for further use. Each file is generated when you click its 'Prepare' button, after which it can be downloaded. The Master files contain all unique records after de-duplication. You can also download the duplicate records for each source in RIS and CSV formats.
     
     ⚠️ Note: The Master files for Cochrane CENTRAL and Embase include both unique trial registry records and records from non-registry sources. De-duplication is only applied to the trial registry records within these databases. 
     
@@ -81,6 +88,13 @@ if 'ictrp_data' not in st.session_state:
     st.session_state.ictrp_data = None
 if 'scanmedicine_data' not in st.session_state:
     st.session_state.scanmedicine_data = None
+if 'upload_version' not in st.session_state:
+    st.session_state.upload_version = 0
+if 'manual_version' not in st.session_state:
+    st.session_state.manual_version = 0
+# manual removals, kept as a log of decisions rather than edited copies of the records; a new upload starts a new log
+if 'decision_log' not in st.session_state:
+    st.session_state.decision_log = new_decision_log()
 
 def set_data_to_preview(source_key):
     st.session_state.data_to_display = source_key
@@ -90,43 +104,126 @@ def clear_preview():
 
 
 def Cochrane_state():
+    st.session_state.upload_version += 1
+    st.session_state.decision_log = new_decision_log()
     st.session_state['Central_IDs'] = []
     st.session_state['Central_df'] =  None
     st.session_state['Central_non_trials_IDs'] = []
     st.session_state['Central_non_trials_df'] =  None
     st.session_state['sorted_df'] = None
-    st.session_state['master_ids'] = None
-    st.session_state['master_records_df'] = None
 
 def Embase_state():
+    st.session_state.upload_version += 1
+    st.session_state.decision_log = new_decision_log()
     st.session_state['Embase_IDs'] = []
     st.session_state['Embase_df'] =  None
     st.session_state['Embase_non_trials_IDs'] = []
     st.session_state['Embase_non_trials_df'] = None
     st.session_state['sorted_df'] = None
-    st.session_state['master_ids'] = None
-    st.session_state['master_records_df'] = None
 
 def ClinicalTirals_state():
+    st.session_state.upload_version += 1
+    st.session_state.decision_log = new_decision_log()
     st.session_state['CT_IDs'] = []
     st.session_state['CT_df'] =  None
     st.session_state['sorted_df'] = None
-    st.session_state['master_ids'] = None
-    st.session_state['master_records_df'] = None
 
 def WHO_ICTRP_state():
+    st.session_state.upload_version += 1
+    st.session_state.decision_log = new_decision_log()
     st.session_state['ICTRP_IDs'] = []
     st.session_state['ICTRP_df'] =  None
     st.session_state['sorted_df'] = None
-    st.session_state['master_ids'] = None
-    st.session_state['master_records_df'] = None
+
+def Linking_state():
+    # the master set changes; manual decisions are kept, as they name records by Trial_ID
+    st.session_state.upload_version += 1
+    st.session_state['sorted_df'] = None
 
 def ScanMedicine_state():
+    st.session_state.upload_version += 1
+    st.session_state.decision_log = new_decision_log()
     st.session_state['SM_IDs'] = []
     st.session_state['SM_df'] =  None
     st.session_state['sorted_df'] = None
-    st.session_state['master_ids'] = None
-    st.session_state['master_records_df'] = None
+
+
+def remove_checked(editor_key, page_ids):
+    # rows ticked in the review table become one batch of decisions
+    edited_rows = st.session_state.get(editor_key, {}).get('edited_rows', {})
+    trial_ids = [page_ids[int(row)] for row, change in edited_rows.items() if change.get('Select')]
+    removed = record_batch(st.session_state.decision_log, trial_ids)
+    if removed:
+        st.session_state.manual_version += 1
+    st.session_state['decision_message'] = f"⚠️ {removed} record(s) removed from the dataset and Export Data tab updated."
+
+def step_decisions(step):
+    step(st.session_state.decision_log)
+    st.session_state.manual_version += 1
+
+def replay_decision_file():
+    decision_file = st.session_state.get('decision_file')
+    if decision_file is None:
+        return
+    try:
+        replayed = replay_decisions(st.session_state.decision_log, read_decisions(decision_file))
+    except ValueError as error:
+        st.session_state['decision_message'] = f"⚠️ {error}"
+        return
+    st.session_state.manual_version += 1
+    st.session_state['decision_message'] = f"⚠️ {replayed} decision(s) replayed and Export Data tab updated."
+
+
+
+# Export files are only built when asked for, then kept until the dedup state changes
+EXPORT_BUTTONS = [
+    ('master_csv', "Master.csv", 'text/csv', 'csv_download_{database}'),
+    ('master_ris', "Master.ris", 'text/RIS', 'ris_download_{database}'),
+    ('duplicate_csv', "Duplicate.csv", 'text/csv', 'csv_download_d{database}'),
+    ('duplicate_ris', "Duplicate.ris", 'text/RIS', 'ris_download_d{database}'),
+]
+
+def export_cache():
+    version = (st.session_state.upload_version, st.session_state.manual_version)
+    cache = st.session_state.get('export_cache')
+    if cache is None or cache['version'] != version:
+        cache = {'version': version, 'requested': set(), 'payloads': {}}
+        st.session_state['export_cache'] = cache
+    return cache
+
+def request_export(export_key):
+    export_cache()['requested'].add(export_key)
+
+def lazy_download_button(export_key, label, build, file_name, mime, button_key):
+    cache = export_cache()
+    if export_key in cache['requested'] and export_key not in cache['payloads']:
+        with st.spinner(f"Preparing {label}..."):
+            cache['payloads'][export_key] = build()
+    if export_key in cache['payloads']:
+        st.download_button(
+            label=label,
+            data=cache['payloads'][export_key],
+            file_name=file_name,
+            mime=mime,
+            key=button_key
+        )
+    else:
+        st.button(f"Prepare {label}", key=f"prepare_{button_key}", on_click=request_export, args=[export_key])
+
+def bundle_download_button(databases, master_records_df, duplicate_records_df, non_trials_by_database):
+    def build():
+        with export_bundle(databases, master_records_df, duplicate_records_df, non_trials_by_database) as bundle:
+            return bundle.read()
+    lazy_download_button(('All', 'bundle_zip'), "All files (ZIP)", build,
+                         'CT-DeDupe_Export.zip', 'application/zip', 'zip_download_all')
+
+def export_buttons(database, master_records_df, duplicate_records_df, non_trials_df):
+    for column, (kind, label, mime, button_key) in zip(st.columns(4), EXPORT_BUTTONS):
+        with column:
+            lazy_download_button(
+                (database, kind), label,
+                lambda kind=kind: export_database(database, kind, master_records_df, duplicate_records_df, non_trials_df),
+                EXPORT_FILE_NAMES[kind].format(database=database), mime, button_key.format(database=database))
 
 
 
@@ -143,8 +240,8 @@ with st.sidebar:
     )
     if uploaded_central_ris:
         # st.success("Data uploaded successfully!")
-        full_central_ris = concatenate_files (uploaded_central_ris, 'ris')
         try:
+            full_central_ris = cached_concatenate_files (uploaded_central_ris, 'ris_records', parallel=True, parse=CENTRAL_Records)
             if full_central_ris:
                 # st.write(CENTRAL_Parse(full_central_ris))
                 st.session_state.central_data,st.session_state.central_non_trials_data = CENTRAL_Parse(full_central_ris)
@@ -171,8 +268,8 @@ with st.sidebar:
     )
     if uploaded_embase_ris:
         # st.success("Data uploaded successfully!")
-        full_embase_ris = concatenate_files (uploaded_embase_ris, 'ris')
         try:
+            full_embase_ris = cached_concatenate_files (uploaded_embase_ris, 'ris_records', parallel=True, parse=Embase_Records)
             if full_embase_ris:
                 # st.session_state.embase_data = Embase_Parse(full_embase_ris)
                 st.session_state.embase_data,st.session_state.embase_non_trials_data = Embase_Parse(full_embase_ris)
@@ -197,7 +294,7 @@ with st.sidebar:
     )
     if ClinicalTrialsGov:
         # st.success("Data uploaded successfully!")
-        df_ct = concatenate_files (ClinicalTrialsGov, 'csv')
+        df_ct = cached_concatenate_files (ClinicalTrialsGov, 'ct_csv', parallel=True)
         
         if df_ct.shape[0]:
             st.session_state.ct_data = ClinicalTrialsGov_Parse(df_ct)
@@ -221,7 +318,7 @@ with st.sidebar:
     )
     if WHO_ICTRP_XML:
         # st.success("Data uploaded successfully!")
-        df_ictrp = concatenate_files (WHO_ICTRP_XML, 'xml')
+        df_ictrp = cached_concatenate_files (WHO_ICTRP_XML, 'ictrp_xml', parallel=True)
         # st.write(f"🎉 Successfully parsed **{(df_ictrp.shape[0])}** records.")
         if df_ictrp.shape[0]:
             st.session_state.ictrp_data = WHO_ICTRP_Parse(df_ictrp)
@@ -246,7 +343,7 @@ with st.sidebar:
     )
     if ScanMedicine_csv:
         # st.success(f"Data uploaded successfully!")
-        df_scanmedicine = concatenate_files (ScanMedicine_csv, 'csv')
+        df_scanmedicine = cached_concatenate_files (ScanMedicine_csv, 'scanmedicine_csv', parallel=True)
         
         if df_scanmedicine.shape[0]:
             st.session_state.scanmedicine_data = ScanMedicine_Parse(df_scanmedicine)
@@ -275,9 +372,9 @@ with st.sidebar:
                 data_source_name = "ScanMedicine"
         
             st.header(f"Previewing Data from: **{data_source_name}**")
-            data_to_show = st.session_state[source_key]
+            data_to_show = st.session_state[source_key].iloc[:100].copy()
             data_to_show.insert(0, 'No.', range(1, len(data_to_show) + 1))
-            st.dataframe(data_to_show.iloc[:100], hide_index=True)
+            st.dataframe(data_to_show, hide_index=True)
             
             
             st.button("Clear Preview", on_click=clear_preview, key="hide_preview_btn")
@@ -357,132 +454,39 @@ with st.sidebar:
             scanmedicine = st.session_state['SM_df']
         else: 
             scanmedicine = None
-        dfs = []
-        if isinstance(central, pd.DataFrame):
-            central_subset = central[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number', 'Source','Volume','Issue']]
-            # central_subset = central_subset.rename(columns={'Author': 'Trial_ID'})
-            central_subset['Trial_ID'] = central['Author'].str.strip()
-            central_subset['Database'] = 'CENTRAL'
-            central_subset['Source_Code'] = 1
-            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Database','Source_Code']
-            central_subset = central_subset[new_order]
-            dfs.append (central_subset)  
-
-        if isinstance(embase, pd.DataFrame):
-            embase_subset = embase[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number', 'Source','Volume','Issue']]
-            # embase_subset = embase_subset.rename(columns={'Acession_Number': 'Trial_ID'})
-            embase_subset['Trial_ID'] = embase['Acession_Number'].str.strip()
-            embase_subset['Database'] = 'EMBASE'
-            embase_subset['Source_Code'] = 2
-            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Database','Source_Code']
-            embase_subset = embase_subset[new_order]
-            # st.write(embase_subset)
-            dfs.append (embase_subset)
-        
-        if isinstance(ct, pd.DataFrame):
-            ct['NCT Number'] = ct['NCT Number'].str.strip()
-            ct_subset = ct[['NCT Number']]
-            ct_subset['Author'] = ct_subset['NCT Number']
-            targeted_tags = ['Study Title', 'First Posted', 'Study URL', "Brief Summary", "Primary Outcome Measures","Secondary Outcome Measures", "Study Status"]
-            for tag in targeted_tags:
-                if tag in ct.columns:
-                    ct_subset[tag] = ct[tag]
-                else:
-                    ct_subset[tag] = ""
-            ct_subset['Note'] = "Study Status: " + ct_subset["Study Status"].fillna('').astype(str) + " " + "OUTCOMS: "+ ct_subset["Primary Outcome Measures"].fillna('').astype(str) + " " + ct_subset["Secondary Outcome Measures"].fillna('').astype(str)
-            ct_subset['Acession_Number'] = ct_subset['NCT Number']
-            ct_subset['Keywords'] = ""
-            ct_subset = ct_subset.rename(columns={'NCT Number': 'Trial_ID', 'Study Title': 'Title', "Brief Summary":'Abstract','First Posted':'Year', 'Study URL':'URL'})
-            ct_subset['Year'] = ct_subset['Year'].str.extract(r'(^[0-9]{4})')
-            ct_subset['Database'] = 'ClinicalTrialsGov'
-            ct_subset['Source_Code'] = 3
-            ct_subset['Source'] = "ClinicalTrials.gov"
-            ct_subset['Volume'] = ""
-            ct_subset['Issue'] = ""
-            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Database','Source_Code']
-            ct_subset = ct_subset[new_order]
-            # st.write(ct_subset)
-            dfs.append (ct_subset)
-
-        if isinstance(ictrp, pd.DataFrame):
-            ictrp['TrialID'] = ictrp['TrialID'].str.strip()
-            ictrp_subset = ictrp[['TrialID']]
-            ictrp_subset['Author'] = ictrp_subset['TrialID'].str.strip()
-            targeted_tags = ['Public_title', 'Date_registration', 'web_address', "Recruitment_Status", "Condition", "Intervention", "Primary_outcome", "Secondary_outcome", "Inclusion_Criteria", "Countries", "Scientific_title", "Internal_Number"]
-            for tag in targeted_tags:
-                if tag in ictrp.columns:
-                    ictrp_subset[tag] = ictrp[tag]
-                else:
-                    ictrp_subset[tag] = ""
-            ictrp_subset['Abstract'] = 'INTERVENTION: '+ ictrp_subset['Intervention'].fillna('').astype(str) + ' CONDITION: ' + ictrp_subset['Condition'].fillna('').astype(str) + " PRIMARY OUTCOME: " + ictrp_subset['Primary_outcome'].fillna('').astype(str) + " SECONDARY OUTCOME: " + ictrp_subset['Secondary_outcome'].fillna('').astype(str) + " INCLUSION CRITERIA: " + ictrp_subset['Inclusion_Criteria'].fillna('').astype(str)
-            ictrp_subset['Note'] = "Scientific title: " + ictrp_subset["Scientific_title"].fillna('').astype(str) + " Recruitment_Status:" +  ictrp_subset["Recruitment_Status"].fillna('').astype(str) + " Country: " + ictrp_subset["Countries"].fillna('').astype(str)
-            ictrp_subset['Keywords'] = ""
-            ictrp_subset['Acession_Number'] = ictrp_subset['Internal_Number']
-            ictrp_subset = ictrp_subset.rename(columns={'TrialID': 'Trial_ID', 'Public_title': 'Title', 'Date_registration':'Year', 'web_address':'URL'})
-            ictrp_subset['Year'] = ictrp_subset['Year'].str.extract(r'([0-9]{4})')
-            ictrp_subset['Database'] = 'WHO_ICTRP'
-            ictrp_subset['Source'] = "WHO ICTRP"
-            ictrp_subset['Volume'] = ""
-            ictrp_subset['Issue'] = ""
-            ictrp_subset['Source_Code'] = 4
-            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number', 'Volume','Issue', 'Database','Source_Code']
-            ictrp_subset = ictrp_subset[new_order]
-            dfs.append (ictrp_subset)
-
-        
-        if isinstance(scanmedicine, pd.DataFrame):
-            scanmedicine['MainID'] = scanmedicine['MainID'].str.strip()
-            scanmedicine_subset = scanmedicine[['MainID']]
-            scanmedicine_subset['Author'] = scanmedicine_subset['MainID'].str.strip()
-            targeted_tags = ['PublicTitle', 'DateOfRegistration', 'DocURL', "TrialStatus", "HealthConditionOrProblemStudied", "Interventions", "PrimaryOutcomes", "InclusionCriteria", "SecondaryOutcomes", "CountriesOfRecruitment", "ScientificTitle"]
-            for tag in targeted_tags:
-                if tag in scanmedicine.columns:
-                    scanmedicine_subset[tag] = scanmedicine[tag]
-                else:
-                    scanmedicine_subset[tag] = ""
-
-            scanmedicine_subset['Abstract'] = 'INTERVENTION: '+ scanmedicine_subset['Interventions'].fillna('').astype(str) + ' CONDITION: ' + scanmedicine_subset['HealthConditionOrProblemStudied'].fillna('').astype(str) + " PRIMARY OUTCOME: " + scanmedicine_subset['PrimaryOutcomes'].fillna('').astype(str) + " SECONDARY OUTCOME: " + scanmedicine_subset['SecondaryOutcomes'].fillna('').astype(str) + " INCLUSION CRITERIA: " + scanmedicine_subset['InclusionCriteria'].fillna('').astype(str)
-            scanmedicine_subset['Note'] = "Scientific title: " + scanmedicine_subset["ScientificTitle"].fillna('').astype(str) + " TrialStatus:" +  scanmedicine_subset["TrialStatus"].fillna('').astype(str) + " Country: " + scanmedicine_subset["CountriesOfRecruitment"].fillna('').astype(str)
-            scanmedicine_subset['Keywords'] = ""
-            scanmedicine_subset['Acession_Number'] = scanmedicine_subset['MainID']
-            scanmedicine_subset = scanmedicine_subset.rename(columns={'MainID': 'Trial_ID', 'PublicTitle': 'Title', 'DateOfRegistration':'Year', 'DocURL':'URL'})
-            scanmedicine_subset['Year'] = scanmedicine_subset['Year'].str.extract(r'(^[0-9]{4})')
-            scanmedicine_subset['Database'] = 'ScanMedicine'
-            scanmedicine_subset['Source'] = 'ScanMedicine'
-            scanmedicine_subset['Volume'] = ""
-            scanmedicine_subset['Issue'] = ""
-            scanmedicine_subset['Source_Code'] = 5
-            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Database','Source_Code']
-            scanmedicine_subset = scanmedicine_subset[new_order]
-            dfs.append(scanmedicine_subset)
-
-        if dfs:
+        link_registry_ids = st.toggle("Link records that share any registry ID (Trial IDs, URLs, registry secondary IDs)",
+                                      key='link_registry_ids', on_change=Linking_state)
+        # Rebuilt only after an upload or the linking option changes; other reruns reuse the memoized frame
+        unified_cache = st.session_state.get('unified_cache')
+        if unified_cache is not None and unified_cache['version'] == st.session_state.upload_version:
+            sorted_df = unified_cache['sorted_df']
+        else:
+            sorted_df = Unified_Records(central, embase, ct, ictrp, scanmedicine)
+            if sorted_df is not None and link_registry_ids:
+                sorted_df = Link_Registry_Records(sorted_df)
+            # the Title/Year match keys are derived once per upload, next to the records they index
+            match_keys = Match_Keys(sorted_df) if sorted_df is not None else None
+            st.session_state['unified_cache'] = {'version': st.session_state.upload_version, 'sorted_df': sorted_df,
+                                                 'match_keys': match_keys}
+
+        if sorted_df is not None:
             with st.expander ("Auto-Deduplication Guide"):
-                st.caption("This table shows the Master (green) and Duplicate (red) records identified and removed by Auto-Deduplication based on Trial IDs. For transparency into the tool's logic, you can download the complete dataset using the **Download Data** link.")
-            combined_df = pd.concat(dfs, ignore_index=True)
-            sorted_df = combined_df.sort_values(by=['Trial_ID', 'Source_Code'],ascending=[True, True]).reset_index(drop=True)
-            sorted_df['Status'] = np.where(sorted_df.groupby('Trial_ID').cumcount() == 0,  'Master', 'Duplicate')
-            sorted_df_new_order = ["Status", "Database", "Trial_ID", "Author", "Title", "Source", "Year", "URL", "Abstract", "Keywords", "Note", "Acession_Number", "Volume", "Issue", "Source_Code"]
-            sorted_df = sorted_df[sorted_df_new_order]
+                st.caption("This table shows the Master (green) and Duplicate (red) records identified and removed by Auto-Deduplication based on Trial IDs. With **Link records that share any registry ID** on, records are also grouped when one lists another's registry number as its own (e.g. an NCT number among an ICTRP record's secondary IDs or in its URL); numbers only mentioned in an abstract or note are not used, and two different IDs from the same registry are never grouped. Each group, numbered in **Link_Group**, keeps one Master. For transparency into the tool's logic, you can download the complete dataset using the **Download Data** link.")
             def color_priority(row):
                 if row['Status'] == 'Master':
                     return ['background-color: #e6ffe6'] * len(row)
                 elif row['Status'] == 'Duplicate':
                     return ['background-color: #ffe6e6'] * len(row)
                 return [''] * len(row)
-            sliced_df = sorted_df.iloc[:100]
+            sliced_df = sorted_df.iloc[:100].copy()
             sliced_df.insert(0, 'No.', range(1, len(sliced_df) + 1))
             styled_df = sliced_df.style.apply(color_priority, axis=1)
             st.dataframe(styled_df, hide_index=True)
             st.session_state['sorted_df'] = sorted_df
-            def convert_df_to_csv(df):
-                return df.to_csv(index=False).encode('utf-8')
-            dfs_to_download = convert_df_to_csv(sorted_df)
-            st.download_button(
-                label="Download Data",
-                data=dfs_to_download,
-                file_name='Auto-Deduplication-Results.csv',
-                mime='text/csv')
+            lazy_download_button(
+                ('All', 'auto_dedup_csv'), "Download Data",
+                lambda: convert_df_to_csv(sorted_df),
+                'Auto-Deduplication-Results.csv', 'text/csv', 'auto_dedup_download')
 
 
     with tab4:
@@ -490,273 +494,128 @@ with st.sidebar:
             sorted_df = st.session_state['sorted_df']
         else: 
             sorted_df = []
-        if 'sorted_df_manual' in st.session_state:
-            sorted_df_manual = st.session_state['sorted_df_manual']
-        else: 
-            sorted_df_manual = []
     
         if isinstance(sorted_df, pd.DataFrame):
-            master_ids = sorted_df[sorted_df['Status'] == 'Master']['Trial_ID'].unique()
             master_records_df = sorted_df[sorted_df['Status'] == 'Master']
-            master_records_df['Title'] = master_records_df['Title'].str.strip()
-            master_records_df['Title'] = master_records_df['Title'].str.lower()
-            master_records_df['Year'] = master_records_df['Year'].str.strip()
-            duplicate_mask_ = master_records_df.duplicated(subset=['Title', 'Year'], keep=False)
-            duplicate_mask_df = master_records_df[duplicate_mask_].copy()
-            duplicate_mask_df = duplicate_mask_df.sort_values(by=['Title', 'Year','Source_Code'], ascending=[True, True, True])
-            duplicate_mask_df.insert(0, 'Select', False, allow_duplicates=False)
+            match_keys = st.session_state['unified_cache']['match_keys']
+            with st.expander("Matching Options"):
+                similar_titles = st.toggle("Also flag similar titles (punctuation, typos, a missing word)", key='similar_titles')
+                similarity_method = st.radio("Compare", ["Title characters", "Title words (TF-IDF)"], horizontal=True,
+                                             key='similarity_method', disabled=not similar_titles)
+                use_abstracts = st.checkbox("Also compare the ICTRP/ScanMedicine registry fields", key='tfidf_abstracts',
+                                            disabled=not similar_titles or similarity_method != "Title words (TF-IDF)")
+                # each method has its own scale, so its own slider and default
+                if similarity_method == "Title words (TF-IDF)":
+                    similarity_threshold = st.slider("Title similarity", 0.5, 1.0, TFIDF_THRESHOLD, 0.05,
+                                                     key='tfidf_threshold', disabled=not similar_titles)
+                else:
+                    similarity_threshold = st.slider("Title similarity", 0.5, 1.0, SIMILARITY_THRESHOLD, 0.05,
+                                                     key='similarity_threshold', disabled=not similar_titles)
+                year_tolerance = st.number_input("Year tolerance (± years)", 0, 5, YEAR_TOLERANCE, key='year_tolerance',
+                                                 help="Registries date a trial by registration or first posting, journals by publication")
+            if similar_titles:
+                # similarity matching is the slow part of this tab; redo it only when the data or settings change
+                similar_key = (st.session_state.upload_version, similarity_method, use_abstracts, similarity_threshold, year_tolerance)
+                similar_cache = st.session_state.get('similar_titles_cache')
+                if similar_cache is None or similar_cache['key'] != similar_key:
+                    with st.spinner("Matching similar titles..."):
+                        if similarity_method == "Title words (TF-IDF)":
+                            candidates = TFIDF_Candidates(master_records_df, similarity_threshold, year_tolerance, use_abstracts)
+                        else:
+                            candidates = Similar_Title_Candidates(master_records_df, similarity_threshold, year_tolerance)
+                        similar_cache = {'key': similar_key, 'candidates': candidates}
+                    st.session_state['similar_titles_cache'] = similar_cache
+                duplicate_mask_df = similar_cache['candidates']
+                group_keys = duplicate_mask_df['Match_Group'].to_numpy()
+            else:
+                duplicate_mask_df = Title_Year_Candidates(master_records_df, match_keys, year_tolerance)
+                group_keys = Title_Year_Groups(match_keys.loc[duplicate_mask_df.index], year_tolerance).to_numpy()
+            # records removed by hand leave their clusters; a cluster left with one record is settled
+            removed = removed_ids(st.session_state.decision_log)
+            if removed:
+                kept = ~duplicate_mask_df['Trial_ID'].isin(removed).to_numpy()
+                kept &= pd.Series(group_keys).where(kept).duplicated(keep=False).to_numpy()
+                duplicate_mask_df, group_keys = duplicate_mask_df[kept], group_keys[kept]
+            clusters_df, cluster_starts = Review_Clusters(duplicate_mask_df, group_keys)
+            n_clusters = len(cluster_starts) - 1
+
+            with st.expander("Manual-Deduplication Guide"):
+                st.caption ('''This table identifies potential duplicate records based on Title and Year; titles are compared ignoring case, accents, punctuation and short words such as 'the' or 'of', and **Year tolerance** under Matching Options lets the years differ by a few years, since registries and journals date the same trial differently. Turn on **Also flag similar titles** under Matching Options to also group titles that differ by punctuation, a typo or a word, optionally within a few years of each other; each group then has a **Match_Group** number. **Title words (TF-IDF)** compares the words of the titles instead, weighting rare words more, and can also compare the intervention, condition and outcome fields of ICTRP and ScanMedicine records. Potential duplicates are grouped into clusters and shown a page at a time; each cluster has a **Cluster** number and its number of **Members**. To simplify the review process, records are color-coded and labelled in **Suggestion**: Green records are suggested to keep, and Red records are suggested for removal. To remove records, select the desired record(s) in the **Select** column and then click the **Remove Checked Records** button; removals made on different pages add up and removed records leave the table. If a record is removed by mistake, click **Undo** (and **Redo** to apply it again). Under **Decision Log**, **Download decisions** saves your removals as a CSV file, and **Replay decisions** applies a saved file to a new session with the same data. Uploading a file starts a new decision log, so download your decisions first if you want to replay them on the new data. Click the Download icon on the top-right of the table to review the data on your device before making changes.''')
+
+            # only the clusters of the current page are styled and sent to the browser
+            page_column, size_column = st.columns(2)
+            clusters_per_page = size_column.selectbox("Clusters per page", [10, 25, 50, 100], index=1, key='clusters_per_page')
+            n_pages = max(1, -(-n_clusters // clusters_per_page))
+            if st.session_state.get('review_page', 1) > n_pages:
+                st.session_state['review_page'] = 1
+            page = page_column.number_input(f"Page (of {n_pages})", 1, n_pages, key='review_page')
+            first_cluster = (page - 1) * clusters_per_page
+            last_cluster = min(first_cluster + clusters_per_page, n_clusters)
+            page_df = clusters_df.iloc[cluster_starts[first_cluster]:cluster_starts[last_cluster]].copy()
+            st.caption(f"{n_clusters} clusters, {len(clusters_df)} records. Showing clusters {min(first_cluster + 1, n_clusters)}–{last_cluster}.")
+            page_df.insert(0, 'Select', False, allow_duplicates=False)
+            page_ids = page_df['Trial_ID'].tolist()
 
             def highlight_rows(df):
                 man_style_df = pd.DataFrame('', index=df.index, columns=df.columns)
                 # df = df.sort_values(by=['Source_Code'],ascending=[True])
-                is_subsequent = df.duplicated(subset=['Title', 'Year'], keep='first')
+                is_subsequent = df['Suggestion'] == 'Remove'
                 man_style_df.loc[~is_subsequent, :] = 'background-color: #e6ffe6'
                 man_style_df.loc[is_subsequent, :] = 'background-color: #ffe6e6'
                 return man_style_df
-            duplicate_mask_df = duplicate_mask_df.style.apply(highlight_rows, axis=None)
-            with st.expander("Manual-Deduplication Guide"):
-                st.caption ('''This table identifies potential duplicate records based on Title and Year. To simplify the review process, pairs are color-coded: Green records are suggested to keep, and Red records are suggested for removal. To remove records, select the desired record(s) in the **Select** column and then click the **Remove Checked Records** button. If a record is removed by mistake, please refresh the tool and re-upload your data. Click the Download icon on the top-right of the table to review the data on your device before making changes.''')
+            page_df = page_df.style.apply(highlight_rows, axis=None)
             
+            # a fresh editor after every decision, so no ticks carry over to the rows that move up
+            editor_key = f"review_editor_{st.session_state.manual_version}"
             edited_df = st.data_editor(
-                    duplicate_mask_df,
+                    page_df,
                     column_config={"Select": st.column_config.CheckboxColumn(required=True)},
-                    disabled=["Status", "Database", "Trial_ID", "Author", "Title", "Source", "Year", "URL", "Abstract", "Keywords", "Note", "Acession_Number", "Volume", "Issue", "Source_Code"],
-                    hide_index=True)
+                    disabled=["Cluster", "Members", "Suggestion", "Match_Group", "Status", "Link_Group", "Database", "Trial_ID", "Author", "Title", "Source", "Year", "URL", "Abstract", "Keywords", "Note", "Acession_Number", "Volume", "Issue", "Source_Code"],
+                    hide_index=True,
+                    key=editor_key)
             
             st.session_state['edited_df'] = edited_df
-            if st.button("Remove Checked Records"):
-                rows_to_remove = edited_df[edited_df['Select'] == True]
-                unwanted_values = list (rows_to_remove['Trial_ID'])
-                rows_to_drop = master_records_df['Trial_ID'].isin(unwanted_values)
-                sorted_df_manual = sorted_df.copy()
-                sorted_df_manual.loc[sorted_df_manual['Trial_ID'].isin(unwanted_values), 'Status'] = 'Duplicate'
-                master_records_df = master_records_df[~rows_to_drop]
-                st.session_state['master_ids'] = master_ids
-                st.session_state['master_records_df'] = master_records_df
-                st.session_state['sorted_df_manual'] = sorted_df_manual
-                st.warning (f"⚠️ {len(rows_to_remove)} record(s) removed from the dataset and Export Data tab updated.")
+            decision_log = st.session_state.decision_log
+            remove_column, undo_column, redo_column = st.columns([2, 1, 1])
+            remove_column.button("Remove Checked Records", on_click=remove_checked, args=[editor_key, page_ids])
+            undo_column.button("Undo", on_click=step_decisions, args=[undo], disabled=not can_undo(decision_log))
+            redo_column.button("Redo", on_click=step_decisions, args=[redo], disabled=not can_redo(decision_log))
+            if 'decision_message' in st.session_state:
+                st.warning(st.session_state.pop('decision_message'))
+            with st.expander("Decision Log"):
+                st.download_button("Download decisions", decisions_to_csv(decision_log), 'CT-DeDupe_Decisions.csv',
+                                   'text/csv', key='decisions_download', disabled=not can_undo(decision_log))
+                st.file_uploader("Replay decisions", type='csv', key='decision_file', on_change=replay_decision_file)
 
     with tab5:
-        if ('master_ids' in st.session_state and 
-    'master_records_df' in st.session_state and 
-    st.session_state['master_ids'] is not None and 
-    st.session_state['master_records_df'] is not None):
+        if isinstance(sorted_df, pd.DataFrame):
             with st.expander ("Data Summary and Export Guide"):
-                st.caption ('''**Data Summary**: This table shows the total number of Master and Duplicate records for each source. Note: For Cochrane CENTRAL and Embase, these figures reflect only Trial Registry records.\n\n**Export Data**: Download the cleaned Master files and identified Duplicates in both CSV and RIS formats.\nNote: The Master files for Cochrane CENTRAL and Embase include both unique trial registry records and records from non-registry sources. De-duplication is only applied to the Trial Registry Records within these databases. ''')
-            master_ids = st.session_state['master_ids']
-            master_records_df = st.session_state['master_records_df']
-            sorted_df_manual = st.session_state['sorted_df_manual']
-            duplicate_ids = sorted_df_manual[sorted_df_manual['Status'] == 'Duplicate']['Trial_ID']
-            duplicate_records_df = sorted_df_manual[sorted_df_manual['Status'] == 'Duplicate']
+                st.caption ('''**Data Summary**: This table shows the total number of Master and Duplicate records for each source. Note: For Cochrane CENTRAL and Embase, these figures reflect only Trial Registry records.\n\n**Export Data**: Download the cleaned Master files and identified Duplicates in both RIS and CSV formats. Click **Prepare** to generate a file, then click it again to download. **All files (ZIP)** bundles every file with a manifest in one download.\nNote: The Master files for Cochrane CENTRAL and Embase include both unique trial registry records and records from non-registry sources. De-duplication is only applied to the Trial Registry records within these databases. ''')
+            # manual decisions are applied as a mask over the auto-deduplicated records
+            removed = removed_mask(sorted_df, st.session_state.decision_log)
+            is_master = (sorted_df['Status'] == 'Master').to_numpy() & ~removed
+            master_records_df = sorted_df[is_master]
+            duplicate_records_df = sorted_df[~is_master]
+            if removed.any():
+                duplicate_records_df = duplicate_records_df.assign(
+                    Status=pd.Categorical(['Duplicate'] * len(duplicate_records_df), dtype=STATUS_DTYPE))
             st.subheader("Data Summary")
-            if isinstance(sorted_df_manual, pd.DataFrame):
-                summary_table = pd.pivot_table(sorted_df_manual, 
-                                             index='Database',
-                                             columns='Status', 
-                                             values='Trial_ID',
-                                             aggfunc='count', 
-                                             fill_value=0 )
-                st.write(summary_table
-                )
-                st.markdown("---")  
-                st.subheader("Export Data")
-                
-                for database in summary_table.index:
-                    st.write(database)
-                    data_to_export = master_records_df[master_records_df['Database'] == database]
-                    data_to_export_dup = duplicate_records_df[duplicate_records_df['Database'] == database]
-                    col1, col2, col3, col4 = st.columns(4)
-                    if database == 'CENTRAL':
-                        if isinstance(central_non_trials_df, pd.DataFrame):
-                            central_non_trials_df_subset = central_non_trials_df[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Source']]
-                            central_non_trials_df_subset['Trial_ID'] = ''
-                            central_non_trials_df_subset['Database'] = 'CENTRAL'
-                            central_non_trials_df_subset['Source_Code'] = 1
-                            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Database','Source_Code']
-                            central_non_trials_df_subset = central_non_trials_df_subset[new_order]
-                            data_to_export_central = pd.concat([data_to_export, central_non_trials_df_subset], ignore_index=True)
-                            csv_data = convert_df_to_csv(data_to_export_central)
-                            ris_data = convert_df_to_ris(data_to_export) + convert_non_trial_df_to_ris (central_non_trials_df_subset)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                        else:
-                            csv_data = convert_df_to_csv(data_to_export)
-                            ris_data = convert_df_to_ris(data_to_export)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-    
-                    elif database == 'EMBASE':
-                        if isinstance(embase_non_trials_df, pd.DataFrame):
-                            embase_non_trials_df_subset = embase_non_trials_df[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Source']]
-                            embase_non_trials_df_subset['Trial_ID'] = ''
-                            embase_non_trials_df_subset['Database'] = 'EMBASE'
-                            embase_non_trials_df_subset['Source_Code'] = 3
-                            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Database','Source_Code']
-                            embase_non_trials_df_subset = embase_non_trials_df_subset[new_order]
-                            data_to_export_embase = pd.concat([data_to_export, embase_non_trials_df_subset], ignore_index=True)
-                            csv_data = convert_df_to_csv(data_to_export_embase)
-                            ris_data = convert_df_to_ris(data_to_export) + convert_non_trial_df_to_ris (embase_non_trials_df_subset)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                        else:
-                            csv_data = convert_df_to_csv(data_to_export)
-                            ris_data = convert_df_to_ris(data_to_export)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                    else:
-                        csv_data = convert_df_to_csv(data_to_export)
-                        ris_data = convert_df_to_ris(data_to_export)
-                        csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                        ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                    
-                    with col1:
-                        st.download_button(
-                            label="Master.csv",
-                            data=csv_data,
-                            file_name=f'{database}Master_Records.csv',
-                            mime='text/csv',
-                            key=f'csv_download_{database}'
-                        )
-                    with col2:
-                        st.download_button(
-                            label="Master.ris",
-                            data=ris_data,
-                            file_name=f'{database}_Master_Records.ris',
-                            mime='text/RIS',
-                            key=f'ris_download_{database}'
-                        )
-                    
-                    
-                    with col3:
-                        st.download_button(
-                            label="Duplicate.csv",
-                            data=csv_data_dup,
-                            file_name=f'{database}_Duplicate_Records.csv',
-                            mime='text/csv',
-                            key=f'csv_download_d{database}'
-                        )
-
- 
-                    with col4:
-                        st.download_button(
-                            label="Duplicate.ris",
-                            data=ris_data_dup,
-                            file_name=f'{database}_Duplicate_Records.ris',
-                            mime='text/RIS',
-                            key=f'ris_download_d{database}'
-                        )
-
+            summary_table = pd.pivot_table(pd.DataFrame({'Database': sorted_df['Database'],
+                                                         'Status': np.where(is_master, 'Master', 'Duplicate'),
+                                                         'Trial_ID': sorted_df['Trial_ID']}),
+                                         index='Database',
+                                         columns='Status', 
+                                         values='Trial_ID',
+                                         aggfunc='count', 
+                                         fill_value=0,
+                                         observed=True)
+            st.write(summary_table)
+            st.markdown("---") 
             
-        else: 
-            if isinstance(sorted_df, pd.DataFrame):
-                with st.expander ("Data Summary and Export Guide"):
-                    st.caption ('''**Data Summary**: This table shows the total number of Master and Duplicate records for each source. Note: For Cochrane CENTRAL and Embase, these figures reflect only Trial Registry records.\n\n**Export Data**: Download the cleaned Master files and identified Duplicates in both RIS and CSV formats.\nNote: The Master files for Cochrane CENTRAL and Embase include both unique trial registry records and records from non-registry sources. De-duplication is only applied to the Trial Registry records within these databases. ''')
-                st.subheader("Data Summary")
-                summary_table = pd.pivot_table(sorted_df, 
-                                             index='Database',
-                                             columns='Status', 
-                                             values='Trial_ID',
-                                             aggfunc='count', 
-                                             fill_value=0 )
-                st.write(summary_table)
-                st.markdown("---") 
-                
-                st.subheader("Export Data")
-                master_ids = sorted_df[sorted_df['Status'] == 'Master']['Trial_ID'].unique()
-                duplicate_ids = sorted_df[sorted_df['Status'] == 'Duplicate']['Trial_ID']
-                master_records_df = sorted_df[sorted_df['Status'] == 'Master']
-                duplicate_records_df = sorted_df[sorted_df['Status'] == 'Duplicate']
-                
-                for database in summary_table.index:
-                    data_to_export = master_records_df[master_records_df['Database'] == database]
-                    data_to_export_dup = duplicate_records_df[duplicate_records_df['Database'] == database]
-                    st.markdown(f"**{database}**")
-                    
-                    
-
-                    if database == 'CENTRAL':
-                        if isinstance(central_non_trials_df, pd.DataFrame):
-                            central_non_trials_df_subset = central_non_trials_df[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Source']]
-                            central_non_trials_df_subset['Trial_ID'] = ''
-                            central_non_trials_df_subset['Database'] = 'CENTRAL'
-                            central_non_trials_df_subset['Source_Code'] = 1
-                            new_order = ['Trial_ID','Author', 'Title', 'Source','Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Database','Source_Code']
-                            central_non_trials_df_subset = central_non_trials_df_subset[new_order]
-                            data_to_export_central = pd.concat([data_to_export, central_non_trials_df_subset], ignore_index=True)
-                            csv_data = convert_df_to_csv(data_to_export_central)
-                            ris_data = convert_df_to_ris(data_to_export) + convert_non_trial_df_to_ris (central_non_trials_df_subset)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                        else:
-                            csv_data = convert_df_to_csv(data_to_export)
-                            ris_data = convert_df_to_ris(data_to_export)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                    elif database == 'EMBASE':
-                        if isinstance(embase_non_trials_df, pd.DataFrame):
-                            embase_non_trials_df_subset = embase_non_trials_df[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Source']]
-                            embase_non_trials_df_subset['Trial_ID'] = ''
-                            embase_non_trials_df_subset['Database'] = 'EMBASE'
-                            embase_non_trials_df_subset['Source_Code'] = 3
-                            new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Database','Source_Code']
-                            embase_non_trials_df_subset = embase_non_trials_df_subset[new_order]
-                            data_to_export_embase = pd.concat([data_to_export, embase_non_trials_df_subset], ignore_index=True)
-                            csv_data = convert_df_to_csv(data_to_export_embase)
-                            ris_data = convert_df_to_ris(data_to_export) + convert_non_trial_df_to_ris (embase_non_trials_df_subset)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                        else:
-                            csv_data = convert_df_to_csv(data_to_export)
-                            ris_data = convert_df_to_ris(data_to_export)
-                            csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                            ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                    else:
-                        csv_data = convert_df_to_csv(data_to_export)
-                        ris_data = convert_df_to_ris(data_to_export)
-                        csv_data_dup = convert_df_to_csv(data_to_export_dup)
-                        ris_data_dup = convert_df_to_ris (data_to_export_dup)
-                    
-                    
-                    
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        st.download_button(
-                            label="Master.csv",
-                            data=csv_data,
-                            file_name=f'{database}Master_Records.csv',
-                            mime='text/csv',
-                            key=f'csv_download_{database}'
-                        )
-                    with col2:
-                        st.download_button(
-                            label="Master.ris",
-                            data=ris_data,
-                            file_name=f'{database}_Master_Records.ris',
-                            mime='text/RIS',
-                            key=f'ris_download_{database}'
-                        )
-                    
-                    
-                    with col3:
-                        st.download_button(
-                            label="Duplicate.csv",
-                            data=csv_data_dup,
-                            file_name=f'{database}_Duplicate_Records.csv',
-                            mime='text/csv',
-                            key=f'csv_download_d{database}'
-                        )
-
- 
-                    with col4:
-                        st.download_button(
-                            label="Duplicate.ris",
-                            data=ris_data_dup,
-                            file_name=f'{database}_Duplicate_Records.ris',
-                            mime='text/RIS',
-                            key=f'ris_download_d{database}'
-                        )
-            
-
-
-
-
+            st.subheader("Export Data")
+            bundle_download_button(summary_table.index, master_records_df, duplicate_records_df,
+                                   {'CENTRAL': central_non_trials_df, 'EMBASE': embase_non_trials_df})
+            for database in summary_table.index:
+                st.markdown(f"**{database}**")
+                export_buttons(database, master_records_df, duplicate_records_df,
+                               {'CENTRAL': central_non_trials_df, 'EMBASE': embase_non_trials_df}.get(database))
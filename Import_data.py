@@ -1,143 +1,52 @@
 import streamlit as st
-import pandas as pd
-import re
+# the parsers themselves live in record_parsers, which does not import Streamlit
+from record_parsers import *
 
 
-def RIS_To_DataFrame (ris_data):
-    tag_map = {
-    'TY': 'Reference_Type',
-    'TI': 'Title', 'T1': 'Title',
-    'AN': 'Acession_Number',
-    'AB': 'Abstract', 'N2': 'Abstract',
-    'AU': 'Author', 'A1': 'Author',
-    'JA': 'Source', 'SO': 'Source', 'JF':'Source',
-    'PY': 'Year', 'Y1': 'Year', 'YR':'Year',
-    'DO': 'DOI', 'DI': 'DOI',
-    'C3': 'Trial Source',
-    'M3': 'Note', 'CY': 'Note',
-    'KW':'Keywords',
-    'UR': 'URL',
-    'DB': 'Database',
-    'PT': 'Publication_Type',
-    'VL':'Volume',
-    'IS':'Issue'}
-    standard_columns = set(tag_map.values())
-    record_splitter = r'ER\s{2}-\s*'
-    line_parser = r'^([A-Z0-9]{2})\s{2}-\s+(.*)'
-    
-    parsed_records = []
-    ris_records = re.split(record_splitter, ris_data.strip())
-    for record_str in ris_records:
-        if not record_str.strip():
-            continue
-            
-        record_dict = {}
-        for line in record_str.strip().split('\n'):
-            match = re.search(line_parser, line.strip())
-            if match:
-                ris_tag = match.group(1).strip()
-                ris_value = match.group(2).strip()
-                standard_tag = tag_map.get(ris_tag)
-    
-                if standard_tag:
-                    if standard_tag in record_dict:
-                        record_dict[standard_tag] += f"; {ris_value}"
-                    else:
-                        record_dict[standard_tag] = ris_value
-        
-        parsed_records.append(record_dict)
-    df = pd.DataFrame(parsed_records, columns=sorted(list(standard_columns)))
-    object_cols = df.select_dtypes(include=['object']).columns
-    df[object_cols] = df[object_cols].where(pd.notna, None)
-    df['Author'] = df['Author'].str.rstrip(',')
-    # st.write(f"🎉 Successfully parsed **{len(parsed_records)}** records.")
-    
-    return df
+def RIS_Diagnostics_Warning (diagnostics):
+    if diagnostics['unterminated_records']:
+        st.warning(f"{diagnostics['unterminated_records']} file(s) end with a record that has no closing 'ER  -' line; it was still imported. Please double check the uploaded data.")
 
 
-def CENTRAL_Parse (data):
-    filtered_CENTRAL_Dataframe = None
-    filtered_CENTRAL_non_trials_Dataframe = None
-    
-    m3_pattern = re.compile(r'M3\s+-\s+Trial registry record', re.MULTILINE)
-    a1_pattern = re.compile(r'A1\s+-\s+(.*)', re.MULTILINE)
+def CENTRAL_Parse (records):
+    # records is the (trials, non-trials, diagnostics) of CENTRAL_Records, which the parse cache keeps
     try:
-        central = data.split("ER  -")[:-1]
-        st.write(f"🎉 Successfully parsed **{len(central)}** records.")               
-        CENTRAL_Dataframe = RIS_To_DataFrame (data)
-        CENTRAL_Dataframe['Note'] = CENTRAL_Dataframe['Note'].str.strip()
-        CENTRAL_Dataframe['Note'] = CENTRAL_Dataframe['Note'].str.lower()
-        central_ids = []
-        central_non_trials = []
-        for idx,record in enumerate(CENTRAL_Dataframe['Note']):
-            if record == "trial registry record":
-                central_ids.append (CENTRAL_Dataframe['Author'][idx].strip())
-            else:
-                central_non_trials.append(CENTRAL_Dataframe['Acession_Number'][idx].strip())
-        if central_ids:
-            central_ids = list (set(central_ids))
-            filtered_CENTRAL_Dataframe = CENTRAL_Dataframe[CENTRAL_Dataframe['Author'].isin(central_ids)]
+        filtered_CENTRAL_Dataframe, filtered_CENTRAL_non_trials_Dataframe, diagnostics = records
+        st.write(f"🎉 Successfully parsed **{diagnostics['record_count']}** records.")
+        RIS_Diagnostics_Warning (diagnostics)
+        if filtered_CENTRAL_Dataframe is not None:
+            central_ids = filtered_CENTRAL_Dataframe['Author'].str.strip().dropna().unique().tolist()
             st.session_state['Central_IDs'] = central_ids
             st.session_state['Central_df'] =  filtered_CENTRAL_Dataframe
             st.write(f"🎉 Successfully identified **{len(central_ids)}** unique trial records.")
-            # return filtered_CENTRAL_Dataframe
-            
         else:
             st.warning("No trial records were identified. Please double check the uploaded data.")
-        if central_non_trials:
-            central_non_trials = list (set(central_non_trials))
-            filtered_CENTRAL_non_trials_Dataframe = CENTRAL_Dataframe[CENTRAL_Dataframe['Acession_Number'].isin(central_non_trials)]
+        if filtered_CENTRAL_non_trials_Dataframe is not None:
+            central_non_trials = filtered_CENTRAL_non_trials_Dataframe['Acession_Number'].str.strip().dropna().unique().tolist()
             st.session_state['Central_non_trials_IDs'] = central_non_trials
             st.session_state['Central_non_trials_df'] =  filtered_CENTRAL_non_trials_Dataframe
 
         return filtered_CENTRAL_Dataframe,filtered_CENTRAL_non_trials_Dataframe
-            # uploaded_ris_file1.seek(0) 
     except Exception as e:
         st.error(f"Error reading RIS file. Please check the uploaded data.")
 
 
-def Embase_Parse (data):
-    filtered_EMBASE_Dataframe = None
-    filtered_EMBASE_non_trials_Dataframe = None
-    db_pattern = re.compile(r'DB\s+-\s+Embase Clinical Trials',re.MULTILINE)
-    an_pattern = re.compile(r'AN\s+-\s+(.*)', re.MULTILINE)
-    # create embase ids list
+def Embase_Parse (records):
+    # records is the (trials, non-trials, diagnostics) of Embase_Records, which the parse cache keeps
     try:
-        embase = data.split("ER  -")[:-1]
-        st.write(f"🎉 Successfully parsed **{len(embase)}** records.")
-        EMBASE_Dataframe = RIS_To_DataFrame (data)
-        EMBASE_Dataframe['Database'] = EMBASE_Dataframe['Database'].str.strip()
-        EMBASE_Dataframe['Database'] = EMBASE_Dataframe['Database'].str.lower()
-        embase_ids = []
-        embase_non_trials = []
-        for idx,record in enumerate(EMBASE_Dataframe['Database']):
-            if record == "embase clinical trials":
-                embase_ids.append (EMBASE_Dataframe['Acession_Number'][idx].strip())
-            else:
-                embase_non_trials.append(EMBASE_Dataframe['Acession_Number'][idx].strip())
-        if embase_ids:
-            embase_ids = list (set(embase_ids))
-            filtered_EMBASE_Dataframe = EMBASE_Dataframe[EMBASE_Dataframe['Acession_Number'].isin(embase_ids)].reset_index(drop=True)
-            embase_urls = []
-            year_cleaned = []
-            for idx in range(len(filtered_EMBASE_Dataframe)):
-                url_splited = filtered_EMBASE_Dataframe['URL'][idx].split("; ")
-                if len (url_splited)>1:
-                    embase_urls.append (url_splited[0])
-                else:
-                    embase_urls.append (url_splited)
-            filtered_EMBASE_Dataframe['URL'] = embase_urls 
-            filtered_EMBASE_Dataframe['Year'] = filtered_EMBASE_Dataframe['Year'].str.rstrip('//')
+        filtered_EMBASE_Dataframe, filtered_EMBASE_non_trials_Dataframe, diagnostics = records
+        st.write(f"🎉 Successfully parsed **{diagnostics['record_count']}** records.")
+        RIS_Diagnostics_Warning (diagnostics)
+        if filtered_EMBASE_Dataframe is not None:
+            embase_ids = filtered_EMBASE_Dataframe['Acession_Number'].str.strip().dropna().unique().tolist()
             st.session_state['Embase_IDs'] = embase_ids
             st.session_state['Embase_df'] =  filtered_EMBASE_Dataframe
             st.write(f"🎉 Successfully identified **{len(embase_ids)}** unique trial records.")
-            # return filtered_EMBASE_Dataframe
         else:
             st.warning("No trial records were identified. Please check the uploaded data.")
 
-        if embase_non_trials:
-            embase_non_trials = list (set(embase_non_trials))
-            filtered_EMBASE_non_trials_Dataframe = EMBASE_Dataframe[EMBASE_Dataframe['Acession_Number'].isin(embase_non_trials)]
+        if filtered_EMBASE_non_trials_Dataframe is not None:
+            embase_non_trials = filtered_EMBASE_non_trials_Dataframe['Acession_Number'].str.strip().dropna().unique().tolist()
             st.session_state['Embase_non_trials_IDs'] = embase_non_trials
             st.session_state['Embase_non_trials_df'] =  filtered_EMBASE_non_trials_Dataframe
         return filtered_EMBASE_Dataframe,filtered_EMBASE_non_trials_Dataframe
@@ -168,8 +77,7 @@ def ClinicalTrialsGov_Parse (data):
 
 def WHO_ICTRP_Parse (data):
     try:
-        df_ictrp = data
-        df_ictrp['TrialID'] = df_ictrp['TrialID'].str.strip()
+        df_ictrp = WHO_ICTRP_Records (data)
         # create ictrp ids list
         ictrp_ids = []
         for i in df_ictrp['TrialID']:
@@ -1,39 +1,32 @@
-import pandas as pd
 import streamlit as st
+# reading and parsing live in record_reader, which does not import Streamlit
+from record_reader import FileReadError, read_files
 
-def concatenate_files(uploaded_files, data_type): #data type could be csv or xml or ris
-        """Reads and concatenates a list of uploaded CSV or XML  or RIS files."""
+
+def concatenate_files(uploaded_files, data_type, parallel=False): #data type could be csv, ct_csv, scanmedicine_csv, xml, ictrp_xml, ris or ris_records
+        """Reads and concatenates a list of uploaded CSV or XML  or RIS files (see read_files).
+
+        Progress of a parallel read is shown in the UI; errors are reported
+        there and None is returned.
+        """
         if not uploaded_files:
             return None
-        all_dfs = []
-        full_ris_text = ""    
-        for file in uploaded_files:
-            try:
-                if data_type == 'csv':
-                    df = pd.read_csv(file)
-                    all_dfs.append(df)
-                elif data_type == 'xml':
-                    df = pd.read_xml(file,parser='etree')
-                    all_dfs.append(df)
-                elif data_type == 'ris':
-                    # Read the content of the file
-                    ris_content = file.read().decode("utf-8")
-                    # Concatenate the content using the + operator
-                    full_ris_text += ris_content + "\n"
-            except Exception as e:
-                st.error(f"Error reading {file.name}: {e}")
-                return None
+        progress_bar = None
+        if parallel and len(uploaded_files) > 1 and data_type != 'ris':
+            progress_bar = st.progress(0, text=f"Reading {len(uploaded_files)} files...")
+
+        def show_progress(done, total):
+            progress_bar.progress(done / total, text=f"Read {done} of {total} files")
 
-        if data_type == 'ris':
-            return full_ris_text
         try:
-            concatenated_df = pd.concat(all_dfs, ignore_index=True)
-            return concatenated_df
+            return read_files(uploaded_files, data_type, parallel=parallel,
+                              progress=show_progress if progress_bar is not None else None)
+        except FileReadError as e:
+            st.error(str(e))
+            return None
         except Exception as e:
             st.error(f"Error concatenating files: {e}")
             return None
-
-
-
-        
-
+        finally:
+            if progress_bar is not None:
+                progress_bar.empty()
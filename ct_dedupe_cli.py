@@ -0,0 +1,200 @@
+"""Headless batch run of CT-DeDupe.
+
+Parses the given exports, removes Trial_ID duplicates, lists the Title/Year
+candidates for manual checking and writes the Master/Duplicate files to a
+directory, e.g.
+
+    python ct_dedupe_cli.py --central central.ris --ct ctgov.csv --ictrp ictrp.xml --out results/
+
+With --project the run is added to a project store (see project_store.py):
+files seen before are skipped, only records new to the project are compared,
+and the exports cover everything the project holds.
+"""
+import argparse
+import os
+import shutil
+import sys
+from contextlib import ExitStack
+import pandas as pd
+from record_reader import read_files
+from record_parsers import CENTRAL_Records, Embase_Records, WHO_ICTRP_Records
+from unified_schema import Unified_Records, Title_Year_Candidates
+from trial_links import Link_Registry_Records
+from fuzzy_titles import Similar_Title_Candidates, SIMILARITY_THRESHOLD, YEAR_TOLERANCE
+from tfidf_similarity import TFIDF_Candidates, TFIDF_THRESHOLD
+from project_store import (open_project, start_run, file_digest, known_file, add_file, update_project,
+                           add_non_trials, record_decisions, import_decisions, project_records, project_non_trials)
+from decision_log import new_decision_log, read_decisions, replay_decisions, removed_mask
+from file_convertor import EXPORT_KINDS, EXPORT_FILE_NAMES, convert_df_to_csv, export_database, export_bundle
+
+
+def read_source(paths, data_type, parallel=False):
+    """Parses a list of files of one source the way the app parses uploads."""
+    if not paths:
+        return None
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(path, 'rb')) for path in paths]
+        return read_files(files, data_type, parallel=parallel)
+
+
+def report_ris_source(diagnostics, trials, label):
+    print(f"{label}: parsed {diagnostics['record_count']} records.", file=sys.stderr)
+    if diagnostics['unterminated_records']:
+        print(f"{label}: {diagnostics['unterminated_records']} file(s) end with a record that has no closing 'ER  -' line.", file=sys.stderr)
+    if trials is None:
+        print(f"{label}: no trial records were identified.", file=sys.stderr)
+
+
+def new_paths(conn, paths, data_type, run):
+    """Drops the files a project has already ingested and registers the others with the run."""
+    if conn is None or not paths:
+        return paths
+    kept = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha256 = file_digest(f)
+        if known_file(conn, sha256):
+            print(f"{path}: already in the project, skipped.", file=sys.stderr)
+            continue
+        add_file(conn, sha256, os.path.basename(path), data_type, run)
+        kept.append(path)
+    return kept
+
+
+def run(args):
+    conn = run_number = decisions = None
+    if args.decisions:
+        try:
+            decisions = read_decisions(args.decisions)
+        except ValueError as error:
+            print(f"{args.decisions}: {error}", file=sys.stderr)
+            return 1
+    if args.project:
+        conn = open_project(args.project)
+        run_number = start_run(conn)
+        if args.remove:
+            with open(args.remove) as f:
+                record_decisions(conn, [line.strip() for line in f if line.strip()])
+        if decisions is not None:
+            import_decisions(conn, decisions)
+    central = central_non_trials = embase = embase_non_trials = None
+    central_paths = new_paths(conn, args.central, 'ris_records', run_number)
+    if central_paths:
+        central, central_non_trials, diagnostics = CENTRAL_Records(read_source(central_paths, 'ris_records', args.parallel))
+        report_ris_source(diagnostics, central, "CENTRAL")
+    embase_paths = new_paths(conn, args.embase, 'ris_records', run_number)
+    if embase_paths:
+        embase, embase_non_trials, diagnostics = Embase_Records(read_source(embase_paths, 'ris_records', args.parallel))
+        report_ris_source(diagnostics, embase, "Embase")
+    ct = read_source(new_paths(conn, args.ct, 'ct_csv', run_number), 'ct_csv', args.parallel)
+    ictrp = read_source(new_paths(conn, args.ictrp, 'ictrp_xml', run_number), 'ictrp_xml', args.parallel)
+    if ictrp is not None:
+        ictrp = WHO_ICTRP_Records(ictrp)
+    scanmedicine = read_source(new_paths(conn, args.scanmedicine, 'scanmedicine_csv', run_number), 'scanmedicine_csv', args.parallel)
+    # a project run reads its records back in order from the store
+    sorted_df = Unified_Records(central, embase, ct, ictrp, scanmedicine, ordered=conn is None)
+    non_trials_by_database = {'CENTRAL': central_non_trials, 'EMBASE': embase_non_trials}
+    if args.link_ids and conn is not None:
+        print("--link-ids is not applied to project stores; records are linked by Trial_ID only.", file=sys.stderr)
+    elif args.link_ids and sorted_df is not None:
+        sorted_df = Link_Registry_Records(sorted_df)
+    if conn is not None:
+        candidates = None
+        if sorted_df is not None:
+            new_records, candidates = update_project(conn, sorted_df, run_number, args.year_tolerance)
+            print(f"{len(new_records)} records are new to the project.", file=sys.stderr)
+        for database, non_trials_df in non_trials_by_database.items():
+            add_non_trials(conn, database, non_trials_df, run_number)
+        conn.commit()
+        sorted_df = project_records(conn)
+        non_trials_by_database = {database: project_non_trials(conn, database) for database in non_trials_by_database}
+        conn.close()
+        if not len(sorted_df):
+            sorted_df = None
+    if sorted_df is None:
+        print("No trial records to deduplicate.", file=sys.stderr)
+        return 1
+    if conn is None and decisions is not None:
+        # the app's decisions, replayed over the same records; a project store applied them itself
+        decision_log = new_decision_log()
+        replay_decisions(decision_log, decisions)
+        removed = removed_mask(sorted_df, decision_log)
+        sorted_df.loc[removed, 'Status'] = 'Duplicate'
+        print(f"{removed.sum()} records were removed by the replayed decisions.", file=sys.stderr)
+    master_records_df = sorted_df[sorted_df['Status'] == 'Master']
+    duplicate_records_df = sorted_df[sorted_df['Status'] == 'Duplicate']
+    if conn is None:
+        candidates = Title_Year_Candidates(master_records_df, year_tolerance=args.year_tolerance)
+    elif candidates is None:
+        candidates = master_records_df.iloc[:0]
+    summary_table = pd.pivot_table(sorted_df, index='Database', columns='Status', values='Trial_ID',
+                                   aggfunc='count', fill_value=0, observed=True)
+
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'Auto-Deduplication-Results.csv'), 'wb') as f:
+        f.write(convert_df_to_csv(sorted_df))
+    with open(os.path.join(args.out, 'Title_Year_Candidates.csv'), 'wb') as f:
+        f.write(convert_df_to_csv(candidates))
+    if args.similar_titles:
+        if args.tfidf:
+            threshold = TFIDF_THRESHOLD if args.similarity is None else args.similarity
+            similar = TFIDF_Candidates(master_records_df, threshold, args.year_tolerance, args.tfidf_abstracts)
+        else:
+            threshold = SIMILARITY_THRESHOLD if args.similarity is None else args.similarity
+            similar = Similar_Title_Candidates(master_records_df, threshold, args.year_tolerance)
+        with open(os.path.join(args.out, 'Similar_Title_Candidates.csv'), 'wb') as f:
+            f.write(convert_df_to_csv(similar))
+        print(f"{len(similar)} master records fall in {similar['Match_Group'].nunique()} groups of similar titles; see Similar_Title_Candidates.csv.")
+    if args.zip:
+        with export_bundle(summary_table.index, master_records_df, duplicate_records_df, non_trials_by_database) as bundle, \
+                open(os.path.join(args.out, 'CT-DeDupe_Export.zip'), 'wb') as f:
+            shutil.copyfileobj(bundle, f)
+    else:
+        for database in summary_table.index:
+            for kind in EXPORT_KINDS:
+                with open(os.path.join(args.out, EXPORT_FILE_NAMES[kind].format(database=database)), 'wb') as f:
+                    f.write(export_database(database, kind, master_records_df, duplicate_records_df,
+                                            non_trials_by_database.get(database)))
+
+    print(summary_table.to_string())
+    if conn is not None:
+        print(f"{len(candidates)} master records share a Title and Year with a new master; see Title_Year_Candidates.csv.")
+    else:
+        print(f"{len(candidates)} master records share a Title and Year with another; see Title_Year_Candidates.csv.")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deduplicate clinical trial records without the web interface.")
+    parser.add_argument('--central', nargs='+', metavar='RIS', help="Cochrane CENTRAL RIS file(s)")
+    parser.add_argument('--embase', nargs='+', metavar='RIS', help="Embase (Ovid) RIS file(s)")
+    parser.add_argument('--ct', nargs='+', metavar='CSV', help="ClinicalTrials.gov CSV file(s)")
+    parser.add_argument('--ictrp', nargs='+', metavar='XML', help="WHO ICTRP XML file(s)")
+    parser.add_argument('--scanmedicine', nargs='+', metavar='CSV', help="ScanMedicine CSV file(s)")
+    parser.add_argument('--link-ids', action='store_true',
+                        help="also treat records that share a registry ID (Trial ID, URL, registry secondary IDs) as one trial")
+    parser.add_argument('--similar-titles', action='store_true',
+                        help="also group masters with similar titles (MinHash) into Similar_Title_Candidates.csv")
+    parser.add_argument('--tfidf', action='store_true',
+                        help="with --similar-titles: compare title words by TF-IDF cosine instead of MinHash")
+    parser.add_argument('--tfidf-abstracts', action='store_true',
+                        help="with --tfidf: also compare the ICTRP/ScanMedicine registry fields")
+    parser.add_argument('--similarity', type=float,
+                        help=f"title similarity for --similar-titles (default {SIMILARITY_THRESHOLD}, {TFIDF_THRESHOLD} with --tfidf)")
+    parser.add_argument('--year-tolerance', type=int, default=YEAR_TOLERANCE,
+                        help=f"allowed year difference between Title/Year and similar-title candidates (default {YEAR_TOLERANCE})")
+    parser.add_argument('--project', metavar='DB', help="project store (SQLite) to update incrementally")
+    parser.add_argument('--remove', metavar='TXT', help="with --project: Trial_IDs (one per line) to mark as duplicates by hand")
+    parser.add_argument('--decisions', metavar='CSV',
+                        help="manual decisions downloaded from the app (Decision Log) to apply to these records")
+    parser.add_argument('--out', required=True, help="directory for the exported files")
+    parser.add_argument('--parallel', action='store_true', help="parse several files of a source at once")
+    parser.add_argument('--zip', action='store_true', help="write all exports into one ZIP with a manifest")
+    args = parser.parse_args(argv)
+    if args.remove and not args.project:
+        parser.error("--remove needs --project")
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+import pandas as pd
+
+# Manual decisions are an append-only log of (Trial_ID, Action, Decided_At)
+# rows, the layout of a project store's decisions table, grouped in batches
+# (one per click). Only the first `applied` batches are in effect, so undo and
+# redo move that count; the records themselves are never copied or edited,
+# the log is applied as a mask (see removed_mask).
+DECISION_COLUMNS = ['Trial_ID', 'Action', 'Decided_At']
+DECISION_ACTIONS = ('remove', 'restore')
+
+
+def new_decision_log():
+    return {'entries': [], 'batch_ends': [], 'applied': 0}
+
+
+def _applied_end(log):
+    return log['batch_ends'][log['applied'] - 1] if log['applied'] else 0
+
+
+def _append_batch(log, entries):
+    # batches undone before are discarded first, like an editor's redo history
+    del log['entries'][_applied_end(log):]
+    del log['batch_ends'][log['applied']:]
+    log['entries'].extend(entries)
+    log['batch_ends'].append(len(log['entries']))
+    log['applied'] += 1
+
+
+def record_batch(log, trial_ids, action='remove', decided_at=None):
+    """Appends one batch of decisions, stamped decided_at (default now); returns the number added."""
+    if action not in DECISION_ACTIONS:
+        raise ValueError(f"Unknown decision action: {action}")
+    trial_ids = list(trial_ids)
+    if not trial_ids:
+        return 0
+    if decided_at is None:
+        decided_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    _append_batch(log, [(trial_id, action, decided_at) for trial_id in trial_ids])
+    return len(trial_ids)
+
+
+def can_undo(log):
+    return log['applied'] > 0
+
+
+def can_redo(log):
+    return log['applied'] < len(log['batch_ends'])
+
+
+def undo(log):
+    if can_undo(log):
+        log['applied'] -= 1
+
+
+def redo(log):
+    if can_redo(log):
+        log['applied'] += 1
+
+
+def applied_decisions(log):
+    """The decisions in effect, oldest first, as a frame of DECISION_COLUMNS."""
+    return pd.DataFrame(log['entries'][:_applied_end(log)], columns=DECISION_COLUMNS)
+
+
+def removed_ids(log):
+    """Trial_IDs whose latest decision in effect is 'remove'."""
+    latest = {}
+    for trial_id, action, _ in log['entries'][:_applied_end(log)]:
+        latest[trial_id] = action
+    return {trial_id for trial_id, action in latest.items() if action == 'remove'}
+
+
+def removed_mask(sorted_df, log):
+    """Boolean array over sorted_df: the records a manual decision turns into Duplicates."""
+    return sorted_df['Trial_ID'].isin(removed_ids(log)).to_numpy()
+
+
+def decisions_to_csv(log):
+    return applied_decisions(log).to_csv(index=False).encode('utf-8')
+
+
+def read_decisions(file):
+    """Reads a decision log written by decisions_to_csv; raises ValueError if it is not one."""
+    decisions = pd.read_csv(file, dtype=str, keep_default_na=False)
+    missing = [column for column in DECISION_COLUMNS if column not in decisions.columns]
+    if missing:
+        raise ValueError(f"Not a decision log: missing column(s) {', '.join(missing)}")
+    unknown = set(decisions['Action']) - set(DECISION_ACTIONS)
+    if unknown:
+        raise ValueError(f"Not a decision log: unknown action(s) {', '.join(sorted(unknown))}")
+    return decisions[DECISION_COLUMNS]
+
+
+def replay_decisions(log, decisions):
+    """Appends a decision frame (see read_decisions) to the log as one batch, keeping its timestamps."""
+    if not len(decisions):
+        return 0
+    _append_batch(log, list(decisions[DECISION_COLUMNS].itertuples(index=False, name=None)))
+    return len(decisions)
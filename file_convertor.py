@@ -1,63 +1,187 @@
-
 import pandas as pd
 import re
+import json
+import tempfile
+import zipfile
+from datetime import datetime, timezone
+from itertools import chain, repeat
+
+RIS_EXPORT_MAPPING = {
+    "DB": "Database",
+    "AN": "Acession_Number",
+    "A1": "Author",
+    "T1": "Title",
+    "JA": "URL",
+    "PY": "Year",
+    "N2": "Abstract",
+    "KW": "Keywords",
+    "UR": "URL",
+    "N1": "Note"
+}
+
+NON_TRIAL_RIS_EXPORT_MAPPING = {
+    "DB": "Database",
+    "AN": "Acession_Number",
+    "A1": "Author",
+    "T1": "Title",
+    "JA": "Source",
+    "PY": "Year",
+    "VL": "Volume",
+    "IS": "Issue",
+    "N2": "Abstract",
+    "KW": "Keywords",
+    "UR": "URL",
+    "N1": "Note"
+}
+
+
+# Registry records keep their ID only in Trial_ID; the exports list it in these
+# fields too, Acession_Number only for the registries without a number of their own
+REGISTRY_ID_FIELDS = {'Author': ['ClinicalTrialsGov', 'WHO_ICTRP', 'ScanMedicine'],
+                      'Acession_Number': ['ClinicalTrialsGov', 'ScanMedicine']}
+
+
+def export_values(df, column):
+    """df[column] as it is exported: registry records get their Trial_ID in the REGISTRY_ID_FIELDS."""
+    values = df[column]
+    if column in REGISTRY_ID_FIELDS and 'Database' in df.columns and 'Trial_ID' in df.columns:
+        values = values.mask(df['Database'].isin(REGISTRY_ID_FIELDS[column]), df['Trial_ID'])
+    return values
 
-def convert_df_to_csv(df):
-                return df.to_csv(index=False).encode('utf-8')
+
+def convert_df_to_csv(df, header=True):
+                derived = {column: export_values(df, column) for column in REGISTRY_ID_FIELDS if column in df.columns}
+                return df.assign(**derived).to_csv(index=False, header=header).encode('utf-8')
+
+
+def _ris_tag_lines(values, tag, keep):
+    """Formats one column as "TAG  - value\\n" lines, with "" for the rows not kept."""
+    return (f"{tag}  - " + values.astype(str) + "\n").where(keep, "")
+
+
+def _join_ris_records(tag_lines, n_records):
+    # one join over TY, every tag line and ER, record by record
+    columns = [repeat("TY  - JOUR\n", n_records)] + [lines.tolist() for lines in tag_lines] + [repeat("ER  - \n\n", n_records)]
+    return "".join(chain.from_iterable(zip(*columns)))
 
 
 def convert_df_to_ris(df):
-    ris_content = ""
-    for index, row in df.iterrows():
-        ris_content += "TY  - JOUR\n"
-        mapping = {
-            "DB": "Database",
-            "AN": "Acession_Number",
-            "A1": "Author",
-            "T1": "Title",
-            "JA": "URL",
-            "PY": "Year",
-            "N2": "Abstract",
-            "KW": "Keywords",
-            "UR": "URL",
-            "N1": "Note"
-        }
-        
-        for tag, col in mapping.items():
-            value = row.get(col)
-            if pd.notna(value) and str(value).lower() != 'nan':
-                ris_content += f"{tag}  - {value}\n"
-        ris_content += "ER  - \n\n" 
-    return ris_content.encode('utf-8')
+    tag_lines = []
+    for tag, col in RIS_EXPORT_MAPPING.items():
+        if col not in df.columns:
+            continue
+        values = export_values(df, col)
+        keep = values.notna() & (values.astype(str).str.lower() != 'nan')
+        tag_lines.append(_ris_tag_lines(values, tag, keep))
+    return _join_ris_records(tag_lines, len(df)).encode('utf-8')
 
 
 def convert_non_trial_df_to_ris(df):
-    ris_content = ""
-    mapping = {
-        "DB": "Database",
-        "AN": "Acession_Number",
-        "A1": "Author",
-        "T1": "Title",
-        "JA": "Source",
-        "PY": "Year",
-        "VL": "Volume",
-        "IS": "Issue",
-        "N2": "Abstract",
-        "KW": "Keywords",
-        "UR": "URL",
-        "N1": "Note"
-    }
-
-    for index, row in df.iterrows():
-        ris_content += "TY  - JOUR\n"
-        for tag, column in mapping.items():
-            value = row.get(column)
-            if tag == "PY" and "/" in str(value):
-                value = str(value).strip("/")
-            if tag == "JA" and len(str(value).split(";")) >1:
-                value = str(value).split(";")[0]                           
-            if pd.notna(value) and str(value).strip().lower() != 'nan' and str(value).strip() != '':
-                ris_content += f"{tag}  - {value}\n"
-        ris_content += "ER  - \n\n"
-    return ris_content.encode('utf-8')
+    tag_lines = []
+    for tag, column in NON_TRIAL_RIS_EXPORT_MAPPING.items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if tag == "PY":
+            text = values.astype(str)
+            values = values.where(~text.str.contains("/", regex=False), text.str.strip("/"))
+        if tag == "JA":
+            text = values.astype(str)
+            values = values.where(~text.str.contains(";", regex=False), text.str.split(";", n=1).str[0])
+        stripped = values.astype(str).str.strip()
+        keep = values.notna() & (stripped.str.lower() != 'nan') & (stripped != '')
+        tag_lines.append(_ris_tag_lines(values, tag, keep))
+    return _join_ris_records(tag_lines, len(df)).encode('utf-8')
+
+
+def non_trial_export_subset(non_trials_df, database, source_code):
+    """Puts a CENTRAL/Embase non-trial frame into the unified column order for export."""
+    subset = non_trials_df[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Source']].copy()
+    subset['Trial_ID'] = ''
+    subset['Database'] = database
+    subset['Source_Code'] = source_code
+    new_order = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue','Database','Source_Code']
+    return subset[new_order]
+
+
+EXPORT_KINDS = ('master_csv', 'master_ris', 'duplicate_csv', 'duplicate_ris')
+EXPORT_FILE_NAMES = {
+    'master_csv': '{database}Master_Records.csv',
+    'master_ris': '{database}_Master_Records.ris',
+    'duplicate_csv': '{database}_Duplicate_Records.csv',
+    'duplicate_ris': '{database}_Duplicate_Records.ris',
+}
+EXPORT_CHUNK_ROWS = 5000
+BUNDLE_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+
+def export_parts(database, kind, master_records_df, duplicate_records_df, non_trials_df=None):
+    """Returns the (frame, writer) pieces that make up one download; kind is one of EXPORT_KINDS.
+
+    Masters of CENTRAL and Embase also carry the database's non-trial records
+    when non_trials_df is given.
+    """
+    if kind in ('master_csv', 'master_ris'):
+        data_to_export = master_records_df[master_records_df['Database'] == database]
+        non_trials_subset = None
+        if isinstance(non_trials_df, pd.DataFrame):
+            # Embase non-trials have always been exported with Source_Code 3
+            non_trials_subset = non_trial_export_subset(non_trials_df, database, 1 if database == 'CENTRAL' else 3)
+        if kind == 'master_csv':
+            if non_trials_subset is not None:
+                data_to_export = pd.concat([data_to_export, non_trials_subset], ignore_index=True)
+            return [(data_to_export, convert_df_to_csv)]
+        if non_trials_subset is not None:
+            return [(data_to_export, convert_df_to_ris), (non_trials_subset, convert_non_trial_df_to_ris)]
+        return [(data_to_export, convert_df_to_ris)]
+    data_to_export_dup = duplicate_records_df[duplicate_records_df['Database'] == database]
+    if kind == 'duplicate_csv':
+        return [(data_to_export_dup, convert_df_to_csv)]
+    if kind == 'duplicate_ris':
+        return [(data_to_export_dup, convert_df_to_ris)]
+    raise ValueError(f"Unknown export kind: {kind}")
+
+
+def iter_export_chunks(parts, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Serializes export parts chunk_rows records at a time; the chunks join to the full file."""
+    for frame, writer in parts:
+        if writer is convert_df_to_csv:
+            yield convert_df_to_csv(frame.iloc[:chunk_rows])
+            for start in range(chunk_rows, len(frame), chunk_rows):
+                yield convert_df_to_csv(frame.iloc[start:start + chunk_rows], header=False)
+        else:
+            for start in range(0, len(frame), chunk_rows):
+                yield writer(frame.iloc[start:start + chunk_rows])
+
+
+def export_database(database, kind, master_records_df, duplicate_records_df, non_trials_df=None):
+    """Builds one download for a database as bytes; see export_parts."""
+    return b"".join(iter_export_chunks(export_parts(database, kind, master_records_df, duplicate_records_df, non_trials_df)))
+
+
+def export_bundle(databases, master_records_df, duplicate_records_df, non_trials_by_database=None):
+    """Writes every database's Master/Duplicate CSV and RIS files plus a manifest.json into a ZIP.
 
+    Each file is compressed chunk by chunk as it is serialized, into a spooled
+    temporary file that moves to disk once it outgrows BUNDLE_SPOOL_MAX_SIZE.
+    Returns that file, rewound.
+    """
+    non_trials_by_database = non_trials_by_database or {}
+    bundle = tempfile.SpooledTemporaryFile(max_size=BUNDLE_SPOOL_MAX_SIZE)
+    manifest = {'generated': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'files': []}
+    with zipfile.ZipFile(bundle, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for database in databases:
+            for kind in EXPORT_KINDS:
+                parts = export_parts(database, kind, master_records_df, duplicate_records_df,
+                                     non_trials_by_database.get(database))
+                file_name = EXPORT_FILE_NAMES[kind].format(database=database)
+                size = 0
+                with zf.open(file_name, 'w') as entry:
+                    for chunk in iter_export_chunks(parts):
+                        entry.write(chunk)
+                        size += len(chunk)
+                manifest['files'].append({'file': file_name, 'database': database, 'kind': kind,
+                                          'records': sum(len(frame) for frame, writer in parts), 'bytes': size})
+        zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+    bundle.seek(0)
+    return bundle
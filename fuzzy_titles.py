@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+from unified_schema import Extract_Years, Title_Keys
+
+# Near-duplicate titles are found with MinHash signatures over character
+# shingles and LSH banding: titles that agree on every row of at least one
+# band share a bucket, and only those pairs are scored. With 16 bands of 6
+# rows a pair at 0.75 similarity is caught ~96% of the time, one at 0.3 ~1%.
+SHINGLE_SIZE = 4
+NUM_PERM = 96
+BANDS = 16
+SIMILARITY_THRESHOLD = 0.75
+YEAR_TOLERANCE = 0
+MAX_BUCKET_SIZE = 50
+SIGNATURE_BLOCK_TITLES = 20000
+
+def _mix(values):
+    # splitmix64 finalizer: spreads the polynomial shingle hash over all 64 bits
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def shingle_hashes(titles, shingle_size=SHINGLE_SIZE):
+    """Hashes every character shingle of every title in one vectorized pass.
+
+    Returns (hashes, owner): a 32-bit hash per shingle and the position of
+    the title it came from, grouped by title in order. Titles shorter than
+    shingle_size have no shingles.
+    """
+    text = '\0'.join(titles) + '\0'
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    n_windows = len(codes) - shingle_size + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    hashes = np.zeros(n_windows, dtype=np.uint64)
+    for offset in range(shingle_size):
+        hashes = hashes * np.uint64(1000003) + codes[offset:offset + n_windows]
+    # a window holding a separator crosses two titles
+    separators = np.concatenate([[0], np.cumsum(codes == 0)])
+    valid = (separators[shingle_size:shingle_size + n_windows] - separators[:n_windows]) == 0
+    owner = separators[:n_windows][valid].astype(np.int64)
+    return _mix(hashes[valid]) >> np.uint64(32), owner
+
+
+def minhash_signatures(titles, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+    """MinHash signatures of the titles' shingle sets, as an (n_titles, num_perm) uint32 array.
+
+    Titles are shingled and hashed SIGNATURE_BLOCK_TITLES at a time so memory
+    stays bounded. Also returns a mask of the titles that have any shingles;
+    the others keep an all-ones signature and should be left out by callers.
+    """
+    rng = np.random.default_rng(seed)
+    # x -> a*x + b mod 2**32 with odd a is a permutation of the 32-bit hashes
+    a = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint32) * np.uint32(2) + np.uint32(1)
+    b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint32)
+    signatures = np.full((len(titles), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    has_shingles = np.zeros(len(titles), dtype=bool)
+    for block_start in range(0, len(titles), SIGNATURE_BLOCK_TITLES):
+        hashes, owner = shingle_hashes(titles[block_start:block_start + SIGNATURE_BLOCK_TITLES], shingle_size)
+        if not len(hashes):
+            continue
+        hashes = hashes.astype(np.uint32)
+        starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        rows = block_start + owner[starts]
+        has_shingles[rows] = True
+        for perm in range(num_perm):
+            permuted = hashes * a[perm]
+            permuted += b[perm]
+            signatures[rows, perm] = np.minimum.reduceat(permuted, starts)
+    return signatures, has_shingles
+
+
+def _band_keys(band):
+    keys = np.full(len(band), 0x9e3779b97f4a7c15, dtype=np.uint64)
+    for column in band.T:
+        keys = _mix(keys ^ column.astype(np.uint64))
+    return keys
+
+
+def lsh_candidate_pairs(signatures, bands=BANDS, max_bucket_size=MAX_BUCKET_SIZE, chain_order=None):
+    """Pairs (i, j), i < j, of signature rows that share a bucket in at least one band.
+
+    Buckets larger than max_bucket_size (e.g. many copies of one title) only
+    pair each member with the next one, in chain_order (e.g. year) when
+    given, so the pair count stays near-linear while the members still end
+    up in one group.
+    """
+    n_titles, num_perm = signatures.shape
+    rows = num_perm // bands
+    pairs = []
+    for band in range(bands):
+        keys = _band_keys(signatures[:, band * rows:(band + 1) * rows])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, n_titles])
+        # buckets of one size are expanded together
+        for size in np.unique(sizes[sizes > 1]):
+            members = order[starts[sizes == size][:, None] + np.arange(size)]
+            if size > max_bucket_size:
+                if chain_order is not None:
+                    members = np.take_along_axis(members, np.argsort(chain_order[members], axis=1, kind='stable'), axis=1)
+                left, right = np.arange(size - 1), np.arange(1, size)
+            else:
+                left, right = np.triu_indices(size, k=1)
+            pairs.append(np.column_stack([members[:, left].ravel(), members[:, right].ravel()]))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def record_years(df):
+    """The year of each record (see Extract_Years) as a float array, NaN where it is missing."""
+    return pd.to_numeric(Extract_Years(df['Year']), errors='coerce').to_numpy(dtype=float)
+
+
+def years_within(left_years, right_years, year_tolerance):
+    """True where two year arrays are at most year_tolerance apart.
+
+    Two missing years match, as in Title_Year_Groups; a missing year never
+    matches a present one.
+    """
+    both_missing = np.isnan(left_years) & np.isnan(right_years)
+    return both_missing | (np.abs(left_years - right_years) <= year_tolerance)
+
+
+def similar_title_pairs(records_df, threshold=SIMILARITY_THRESHOLD, year_tolerance=YEAR_TOLERANCE,
+                        shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM, bands=BANDS):
+    """Scores the LSH candidate pairs of records_df and keeps those at or above threshold.
+
+    Similarity is the MinHash estimate of the Jaccard index of the shingle
+    sets of the titles, folded by Title_Keys as in the Title/Year table.
+    Pairs must also be within year_tolerance years (None skips the year
+    check; see years_within for missing years). Records without a title are
+    never paired. Returns a frame of Left/Right index labels and Similarity,
+    most similar first.
+    """
+    titles = Title_Keys(records_df['Title'])
+    # a title shorter than a shingle becomes one padded shingle
+    titles = titles.where(titles.str.len() >= shingle_size, titles.str.pad(shingle_size, side='right').where(titles != '', ''))
+    signatures, has_shingles = minhash_signatures(titles.tolist(), num_perm, shingle_size)
+    years = record_years(records_df)
+    pairs = lsh_candidate_pairs(signatures, bands, chain_order=years)
+    pairs = pairs[has_shingles[pairs[:, 0]] & has_shingles[pairs[:, 1]]]
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    keep = similarity >= threshold
+    if year_tolerance is not None:
+        keep &= years_within(years[pairs[:, 0]], years[pairs[:, 1]], year_tolerance)
+    pairs, similarity = pairs[keep], similarity[keep]
+    order = np.argsort(-similarity, kind='stable')
+    return pd.DataFrame({'Left': records_df.index[pairs[order, 0]], 'Right': records_df.index[pairs[order, 1]],
+                         'Similarity': similarity[order]})
+
+
+def match_groups(n_items, left, right):
+    """Connected components of the pairs (left[k], right[k]) over positions 0..n_items-1.
+
+    Labels are propagated along the pairs with pointer jumping until stable;
+    each component is labelled with its smallest position.
+    """
+    labels = np.arange(n_items)
+    while True:
+        lowest = np.minimum(labels[left], labels[right])
+        updated = labels.copy()
+        np.minimum.at(updated, left, lowest)
+        np.minimum.at(updated, right, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def Pair_Candidates (master_records_df, pairs):
+    """Master records linked by the Left/Right pairs of a pair frame, grouped for review.
+
+    Adds a Match_Group column numbering the connected groups of records (see
+    match_groups); rows are ordered by group and Source_Code, like
+    Title_Year_Candidates. Records in no pair are left out.
+    """
+    left = master_records_df.index.get_indexer(pairs['Left'])
+    right = master_records_df.index.get_indexer(pairs['Right'])
+    labels = match_groups(len(master_records_df), left, right)
+    linked = np.zeros(len(master_records_df), dtype=bool)
+    linked[left] = linked[right] = True
+    candidates = master_records_df[linked].copy()
+    candidates.insert(0, 'Match_Group', pd.factorize(labels[linked], sort=True)[0] + 1)
+    return candidates.sort_values(by=['Match_Group', 'Source_Code'], kind='stable')
+
+
+def Similar_Title_Candidates (master_records_df, threshold=SIMILARITY_THRESHOLD, year_tolerance=YEAR_TOLERANCE):
+    """Master records with a similar title (see similar_title_pairs), grouped for review by Pair_Candidates."""
+    return Pair_Candidates(master_records_df, similar_title_pairs(master_records_df, threshold, year_tolerance))
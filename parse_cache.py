@@ -0,0 +1,75 @@
+import copy
+from collections import OrderedDict
+import pandas as pd
+import streamlit as st
+from concatenate_files import concatenate_files
+
+# Kept in the session's own state, so parsed uploads go when the session ends
+# and are never shared between sessions. Entries are weighed by the size of
+# the uploaded bytes they came from, which tracks the parsed frame's size
+# closely enough to keep memory predictable.
+PARSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PARSE_CACHE_MAX_ENTRIES = 10
+
+
+def upload_key(uploaded_files, data_type):
+    """The data type with each upload's file_id and size (in order), or None when a file has no file_id.
+
+    Streamlit gives every upload its own file_id, so the bytes need not be
+    read to tell whether the files changed.
+    """
+    file_ids = [getattr(file, 'file_id', None) for file in uploaded_files]
+    if None in file_ids:
+        return None, 0
+    sizes = [file.size for file in uploaded_files]
+    return (data_type, tuple(zip(file_ids, sizes))), sum(sizes)
+
+
+def _fresh_copy(result):
+    # callers (and the app) modify the frames they get, so never hand out the cached object
+    if isinstance(result, pd.DataFrame):
+        return result.copy()
+    if isinstance(result, tuple):
+        return tuple(_fresh_copy(item) for item in result)
+    return copy.deepcopy(result)
+
+
+def _session_parse_cache():
+    if 'parse_cache' not in st.session_state:
+        st.session_state['parse_cache'] = {'entries': OrderedDict(), 'bytes': 0}
+    return st.session_state['parse_cache']
+
+
+def cached_concatenate_files(uploaded_files, data_type, parallel=False, parse=None):
+    """concatenate_files with a bounded, per-session LRU cache keyed by the uploads' file_id and size.
+
+    Streamlit reruns the script on every interaction; an unchanged upload is
+    then served from memory instead of being read again. With parse (e.g.
+    CENTRAL_Records) the cached value is parse(concatenated files), so the
+    split into trials and non-trials is not redone either.
+    """
+    if not uploaded_files:
+        return None
+    key, size = upload_key(uploaded_files, data_type)
+    if key is not None and parse is not None:
+        key += (parse.__name__,)
+    cache = _session_parse_cache()
+    entry = cache['entries'].get(key) if key is not None else None
+    if entry is not None:
+        cache['entries'].move_to_end(key)
+        return _fresh_copy(entry[0])
+
+    result = concatenate_files(uploaded_files, data_type, parallel=parallel)
+    if result is not None and parse is not None:
+        result = parse(result)
+    if key is None or result is None or size > PARSE_CACHE_MAX_BYTES:
+        return result
+    cache['entries'][key] = (result, size)
+    cache['bytes'] += size
+    while cache['bytes'] > PARSE_CACHE_MAX_BYTES or len(cache['entries']) > PARSE_CACHE_MAX_ENTRIES:
+        cache['bytes'] -= cache['entries'].popitem(last=False)[1][1]
+    return _fresh_copy(result)
+
+
+def clear_parse_cache():
+    st.session_state.pop('parse_cache', None)
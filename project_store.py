@@ -0,0 +1,195 @@
+import hashlib
+import sqlite3
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from unified_schema import SORTED_COLUMNS, Compact_Records, Master_Status, Match_Keys, Title_Year_Groups, Title_Year_Candidates
+
+# A living review keeps one SQLite file per project. Each run adds only the
+# records the project has not seen (by Database and Trial_ID) and compares them
+# with the stored masters through the indexes below, so the cost of an update
+# follows the size of the new records rather than the whole history.
+PROJECT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    Status TEXT, Database TEXT, Trial_ID TEXT, Author TEXT, Title TEXT, Source TEXT, Year TEXT, URL TEXT,
+    Abstract TEXT, Keywords TEXT, Note TEXT, Acession_Number TEXT, Volume TEXT, Issue TEXT, Source_Code INTEGER,
+    Title_Key TEXT, Year_Key TEXT, Run INTEGER);
+CREATE INDEX IF NOT EXISTS records_trial_id ON records (Trial_ID, Status);
+CREATE INDEX IF NOT EXISTS records_database_trial_id ON records (Database, Trial_ID);
+CREATE INDEX IF NOT EXISTS records_database_accession ON records (Database, Acession_Number);
+CREATE INDEX IF NOT EXISTS records_title_year ON records (Title_Key, Year_Key, Status);
+CREATE TABLE IF NOT EXISTS non_trials (
+    Database TEXT, Author TEXT, Title TEXT, Year TEXT, URL TEXT, Abstract TEXT, Keywords TEXT, Note TEXT,
+    Acession_Number TEXT, Volume TEXT, Issue TEXT, Source TEXT, Run INTEGER);
+CREATE INDEX IF NOT EXISTS non_trials_accession ON non_trials (Database, Acession_Number);
+CREATE TABLE IF NOT EXISTS decisions (Trial_ID TEXT, Action TEXT, Decided_At TEXT);
+CREATE TABLE IF NOT EXISTS runs (Run INTEGER PRIMARY KEY, Started_At TEXT);
+CREATE TABLE IF NOT EXISTS files (Sha256 TEXT PRIMARY KEY, File_Name TEXT, Data_Type TEXT, Run INTEGER);
+"""
+# Trial_IDs whose latest decision is a removal; a later 'restore' (see decision_log.py) undoes it
+REMOVED_IDS_QUERY = ("SELECT Trial_ID FROM decisions AS latest WHERE Action = 'remove' "
+                     "AND rowid = (SELECT MAX(rowid) FROM decisions WHERE Trial_ID = latest.Trial_ID)")
+NON_TRIAL_COLUMNS = ['Author', 'Title', 'Year', 'URL', 'Abstract', 'Keywords', 'Note', 'Acession_Number', 'Volume', 'Issue', 'Source']
+
+
+def open_project(path):
+    """Opens (creating if needed) a project store and returns the sqlite3 connection."""
+    conn = sqlite3.connect(path)
+    conn.executescript(PROJECT_SCHEMA)
+    return conn
+
+
+def file_digest(file, chunk_size=1 << 20):
+    """sha256 of an open binary file, read in chunks and rewound afterwards."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def known_file(conn, sha256):
+    return conn.execute("SELECT 1 FROM files WHERE Sha256 = ?", (sha256,)).fetchone() is not None
+
+
+def add_file(conn, sha256, file_name, data_type, run):
+    conn.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?)", (sha256, file_name, data_type, run))
+
+
+def start_run(conn):
+    """Registers a new run and returns its number."""
+    cursor = conn.execute("INSERT INTO runs (Started_At) VALUES (?)",
+                          (datetime.now(timezone.utc).isoformat(timespec='seconds'),))
+    return cursor.lastrowid
+
+
+def _temp_table(conn, name, columns, rows):
+    conn.execute(f"DROP TABLE IF EXISTS temp.{name}")
+    conn.execute(f"CREATE TEMP TABLE {name} ({', '.join(columns)})")
+    conn.executemany(f"INSERT INTO temp.{name} VALUES ({', '.join('?' * len(columns))})", rows)
+
+
+def _sql_values(df):
+    # sqlite3 takes None, not NaN, for NULL
+    return df.astype(object).where(df.notna(), None)
+
+
+def removed_ids(conn):
+    """Trial_IDs the reviewers removed by hand in earlier runs."""
+    return {row[0] for row in conn.execute(REMOVED_IDS_QUERY)}
+
+
+def record_decisions(conn, trial_ids, action='remove'):
+    decided_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    conn.executemany("INSERT INTO decisions VALUES (?, ?, ?)", [(trial_id, action, decided_at) for trial_id in trial_ids])
+    conn.commit()
+
+
+def import_decisions(conn, decisions_df):
+    """Appends a decision log exported by the app (see decision_log.read_decisions), keeping its timestamps."""
+    conn.executemany("INSERT INTO decisions VALUES (?, ?, ?)",
+                     decisions_df[['Trial_ID', 'Action', 'Decided_At']].itertuples(index=False, name=None))
+    conn.commit()
+
+
+def _known_records(conn, records_df, id_column):
+    # which records the project already holds under the same Database and id_column; a NULL never matches
+    incoming = records_df[['Database', id_column]].dropna().drop_duplicates()
+    _temp_table(conn, 'incoming', ['Database', id_column], incoming.itertuples(index=False, name=None))
+    condition = "" if id_column == 'Trial_ID' else " WHERE records.Trial_ID IS NULL"
+    known = pd.read_sql_query(
+        f"SELECT DISTINCT Database, {id_column} FROM records JOIN temp.incoming USING (Database, {id_column}){condition}", conn)
+    if not len(known):
+        return np.zeros(len(records_df), dtype=bool)
+    return pd.MultiIndex.from_frame(records_df[['Database', id_column]].astype(object)).isin(pd.MultiIndex.from_frame(known))
+
+
+def update_project(conn, sorted_df, run, year_tolerance=0):
+    """Adds the records of sorted_df (see Unified_Records) that the project does not hold yet.
+
+    A new record becomes the Master when the project has no master for its
+    Trial_ID, or when its Source_Code is lower than the stored master's,
+    which is then marked Duplicate; ties keep the stored master, as the
+    first of a Trial_ID always has. Returns (new records, Title/Year
+    candidates), where the candidates are the Title_Year_Groups, over all
+    masters not removed by hand, that hold a new master: the groups a
+    one-shot run over the whole project would list for those records.
+    """
+    has_id = sorted_df['Trial_ID'].notna().to_numpy()
+    is_known = np.zeros(len(sorted_df), dtype=bool)
+    is_known[has_id] = _known_records(conn, sorted_df[has_id], 'Trial_ID')
+    # records without a Trial_ID are known by their Acession_Number, as non-trial records are
+    is_known[~has_id] = _known_records(conn, sorted_df[~has_id], 'Acession_Number')
+    delta = sorted_df[~is_known].copy()
+    if not len(delta):
+        conn.commit()
+        return delta, delta.iloc[:0]
+
+    _temp_table(conn, 'delta_ids', ['Trial_ID'], ((trial_id,) for trial_id in delta['Trial_ID'].dropna().unique()))
+    stored_masters = pd.read_sql_query(
+        "SELECT Trial_ID, Source_Code FROM records JOIN temp.delta_ids USING (Trial_ID) WHERE Status = 'Master'", conn)
+    # stored masters come first, so they win ties
+    combined = pd.concat([stored_masters.assign(Stored=True),
+                          delta[['Trial_ID', 'Source_Code']].assign(Stored=False)], ignore_index=True)
+    combined['Status'] = Master_Status(combined)
+    demoted = combined.loc[combined['Stored'] & (combined['Status'] == 'Duplicate'), 'Trial_ID']
+    delta['Status'] = combined.loc[~combined['Stored'], 'Status'].to_numpy()
+    conn.executemany("UPDATE records SET Status = 'Duplicate' WHERE Trial_ID = ? AND Status = 'Master'",
+                     ((trial_id,) for trial_id in demoted))
+
+    keys = Match_Keys(delta)
+    rows = _sql_values(delta[SORTED_COLUMNS])
+    rows['Title_Key'] = keys['Title_Key']
+    rows['Year_Key'] = keys['Year_Key']
+    rows['Run'] = run
+    conn.executemany(f"INSERT INTO records ({', '.join(rows.columns)}) VALUES ({', '.join('?' * len(rows.columns))})",
+                     rows.itertuples(index=False, name=None))
+
+    title_keys = keys.loc[delta['Status'] == 'Master', 'Title_Key'].drop_duplicates()
+    _temp_table(conn, 'delta_keys', ['Title_Key'], ((title_key,) for title_key in title_keys))
+    # the Title_Key index narrows the lookup to the new masters' titles; all their years are read,
+    # as Title_Year_Groups chains a title's neighbouring years, so a group can reach any of them
+    masters = pd.read_sql_query(
+        f"SELECT {', '.join(SORTED_COLUMNS)}, Run FROM records WHERE Status = 'Master' "
+        "AND Title_Key IN (SELECT Title_Key FROM temp.delta_keys) "
+        f"AND Trial_ID NOT IN ({REMOVED_IDS_QUERY}) ORDER BY rowid",
+        conn)
+    conn.commit()
+    master_keys = Match_Keys(masters)
+    groups = Title_Year_Groups(master_keys, year_tolerance)
+    with_new = groups.isin(groups[masters['Run'] == run]).to_numpy()
+    candidates = Title_Year_Candidates(masters.loc[with_new, SORTED_COLUMNS], master_keys, year_tolerance)
+    return delta[SORTED_COLUMNS], candidates
+
+
+def add_non_trials(conn, database, non_trials_df, run):
+    """Stores the non-trial records of a CENTRAL/Embase run whose Acession_Number is new to the project."""
+    if non_trials_df is None or not len(non_trials_df):
+        return 0
+    rows = _sql_values(non_trials_df[NON_TRIAL_COLUMNS])
+    _temp_table(conn, 'incoming_accessions', ['Acession_Number'],
+                ((accession,) for accession in rows['Acession_Number'].dropna().unique()))
+    known = {row[0] for row in conn.execute(
+        "SELECT DISTINCT Acession_Number FROM non_trials JOIN temp.incoming_accessions USING (Acession_Number) "
+        "WHERE Database = ?", (database,))}
+    rows = rows[~rows['Acession_Number'].isin(known)]
+    rows.insert(0, 'Database', database)
+    rows['Run'] = run
+    conn.executemany(f"INSERT INTO non_trials ({', '.join(rows.columns)}) VALUES ({', '.join('?' * len(rows.columns))})",
+                     rows.itertuples(index=False, name=None))
+    conn.commit()
+    return len(rows)
+
+
+def project_records(conn):
+    """All trial records of the project in Unified_Records order, with the manual removals applied."""
+    sorted_df = pd.read_sql_query(
+        f"SELECT {', '.join(SORTED_COLUMNS)} FROM records ORDER BY Trial_ID IS NULL, Trial_ID, Source_Code, rowid", conn)
+    sorted_df.loc[sorted_df['Trial_ID'].isin(removed_ids(conn)), 'Status'] = 'Duplicate'
+    return Compact_Records(sorted_df)
+
+
+def project_non_trials(conn, database):
+    non_trials_df = pd.read_sql_query(
+        f"SELECT {', '.join(NON_TRIAL_COLUMNS)} FROM non_trials WHERE Database = ? ORDER BY rowid", conn, params=(database,))
+    return non_trials_df if len(non_trials_df) else None
@@ -0,0 +1,260 @@
+import pandas as pd
+import numpy as np
+import re
+from xml.etree import ElementTree
+
+try:
+    import pyarrow  # optional: a faster engine for the CSV loaders
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+
+RIS_TAG_MAP = {
+    'TY': 'Reference_Type',
+    'TI': 'Title', 'T1': 'Title',
+    'AN': 'Acession_Number',
+    'AB': 'Abstract', 'N2': 'Abstract',
+    'AU': 'Author', 'A1': 'Author',
+    'JA': 'Source', 'SO': 'Source', 'JF':'Source',
+    'PY': 'Year', 'Y1': 'Year', 'YR':'Year',
+    'DO': 'DOI', 'DI': 'DOI',
+    'C3': 'Trial Source',
+    'M3': 'Note', 'CY': 'Note',
+    'KW':'Keywords',
+    'UR': 'URL',
+    'DB': 'Database',
+    'PT': 'Publication_Type',
+    'VL':'Volume',
+    'IS':'Issue'}
+RIS_COLUMNS = sorted(set(RIS_TAG_MAP.values()))
+
+# "ER  -" closes a record wherever it appears, as the old re.split did.
+RIS_RECORD_END = re.compile(r'ER\s{2}-\s*')
+RIS_LINE = re.compile(r'([A-Z0-9]{2})\s{2}-\s+(.*)')
+RIS_CHUNK_SIZE = 1 << 20
+
+
+def iter_RIS_Lines (ris_data):
+    """Yields the lines of a RIS string, a text stream or a bytes upload one at a time."""
+    if isinstance(ris_data, str):
+        # split about a megabyte at a time so no full list of lines is ever held
+        find = ris_data.find
+        start = 0
+        size = len(ris_data)
+        while start < size:
+            end = find('\n', start + RIS_CHUNK_SIZE)
+            if end == -1:
+                end = size
+            yield from ris_data[start:end].split('\n')
+            start = end + 1
+        return
+    for line in ris_data:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        yield line.rstrip('\n')
+
+
+def new_RIS_Diagnostics ():
+    return {'record_count': 0, 'unterminated_records': 0, 'untagged_lines': 0, 'unmapped_tags': {}}
+
+
+def _store_RIS_Line (record_dict, line, diagnostics):
+    # one stripped line of a record: its tag's value, or a count in diagnostics
+    match = RIS_LINE.match(line)
+    if match:
+        standard_tag = RIS_TAG_MAP.get(match.group(1))
+        if standard_tag:
+            ris_value = match.group(2).strip()
+            if standard_tag in record_dict:
+                record_dict[standard_tag] += f"; {ris_value}"
+            else:
+                record_dict[standard_tag] = ris_value
+        else:
+            unmapped_tags = diagnostics['unmapped_tags']
+            unmapped_tags[match.group(1)] = unmapped_tags.get(match.group(1), 0) + 1
+    else:
+        diagnostics['untagged_lines'] += 1
+
+
+def iter_RIS_Records (lines, diagnostics=None):
+    """Streams RIS lines and yields one {column: value} dict per record.
+
+    If a diagnostics dict (see new_RIS_Diagnostics) is given it is filled in
+    as the records go past, so callers never need a second pass to count them.
+    """
+    if diagnostics is None:
+        diagnostics = new_RIS_Diagnostics()
+    search_end = RIS_RECORD_END.search
+    store_line = _store_RIS_Line
+    record_dict = {}
+    has_content = False
+    for line in lines:
+        if 'ER' in line and search_end(line):
+            # rare path: one or more terminators inside this line
+            for i, piece in enumerate(RIS_RECORD_END.split(line)):
+                if i:
+                    diagnostics['record_count'] += 1
+                    if has_content:
+                        yield record_dict
+                    record_dict = {}
+                    has_content = False
+                piece = piece.strip()
+                if piece:
+                    has_content = True
+                    store_line(record_dict, piece, diagnostics)
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        has_content = True
+        store_line(record_dict, line, diagnostics)
+    if has_content:
+        diagnostics['unterminated_records'] += 1
+        yield record_dict
+
+
+def RIS_Parse (ris_data):
+    """Parses RIS data in a single pass and returns (DataFrame, diagnostics).
+
+    diagnostics['record_count'] is the number of "ER  -" terminated records,
+    the figure the upload messages report.
+    """
+    diagnostics = new_RIS_Diagnostics()
+    columns = {column: [] for column in RIS_COLUMNS}
+    appenders = [(column, values.append) for column, values in columns.items()]
+    seen_columns = set()
+    for record_dict in iter_RIS_Records(iter_RIS_Lines(ris_data), diagnostics):
+        seen_columns.update(record_dict)
+        for column, append in appenders:
+            append(record_dict.get(column))
+    df = pd.DataFrame(columns, columns=RIS_COLUMNS, dtype=object)
+    if len(df):
+        # tags that never occur stay all-NaN float columns, as they always have
+        for column in RIS_COLUMNS:
+            if column not in seen_columns:
+                df[column] = np.nan
+    df['Author'] = df['Author'].str.rstrip(',')
+    
+    return df, diagnostics
+
+
+def RIS_To_DataFrame (ris_data):
+    df, diagnostics = RIS_Parse(ris_data)
+    return df
+
+
+ICTRP_COLUMNS = ['TrialID', 'Internal_Number', 'Public_title', 'Scientific_title', 'Date_registration', 'web_address',
+                 'Recruitment_Status', 'Condition', 'Intervention', 'Primary_outcome', 'Secondary_outcome',
+                 'Inclusion_Criteria', 'Countries', 'Secondary_ID', 'Secondary_IDs', 'SecondaryIDs']
+
+
+def ICTRP_XML_To_DataFrame (xml_file, columns=ICTRP_COLUMNS):
+    """Streams a WHO ICTRP XML export and keeps only the given child fields of each trial.
+
+    Every child of the root element is one row, as with pd.read_xml, but the
+    tree is never built: each trial is read with iterparse and cleared at once.
+    Values stay as text, stripped (None when empty); fields absent from the whole file
+    get no column.
+    """
+    wanted = set(columns)
+    data = {column: [] for column in columns}
+    seen_columns = set()
+    row = {}
+    depth = 0
+    root = None
+    for event, elem in ElementTree.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+            continue
+        if depth == 3:
+            tag = elem.tag.split('}')[1] if '}' in elem.tag else elem.tag
+            if tag in wanted:
+                # surrounding whitespace and newlines are dropped, as pd.read_xml does
+                text = elem.text.strip() if elem.text else ''
+                row[tag] = text if text else None
+        elif depth == 2:
+            for column in columns:
+                data[column].append(row.get(column))
+            seen_columns.update(row)
+            row = {}
+            elem.clear()
+            root.clear()
+        depth -= 1
+    return pd.DataFrame({column: data[column] for column in columns if column in seen_columns}, dtype=object)
+
+
+CT_GOV_COLUMNS = ['NCT Number', 'Study Title', 'First Posted', 'Study URL', 'Brief Summary',
+                  'Primary Outcome Measures', 'Secondary Outcome Measures', 'Study Status']
+SCANMEDICINE_COLUMNS = ['MainID', 'PublicTitle', 'ScientificTitle', 'DateOfRegistration', 'DocURL', 'TrialStatus',
+                        'HealthConditionOrProblemStudied', 'Interventions', 'PrimaryOutcomes', 'SecondaryOutcomes',
+                        'InclusionCriteria', 'CountriesOfRecruitment', 'SecondaryIDs', 'SecondaryId', 'Secondary_IDs']
+
+
+def CSV_To_DataFrame (csv_file, columns, source):
+    """Reads only the given columns of an uploaded CSV, all as strings.
+
+    The header is read first so columns missing from an export are simply
+    left out rather than failing the read; a file with none of them raises
+    ValueError naming source, as it is not such an export at all.
+    """
+    header = pd.read_csv(csv_file, nrows=0).columns
+    csv_file.seek(0)
+    wanted = set(columns)
+    usecols = [column for column in header if column in wanted]
+    if not usecols:
+        # an empty usecols would make the pyarrow engine read every column
+        raise ValueError(f"not a {source} export: none of its columns ({', '.join(columns[:3])}, ...) were found")
+    return pd.read_csv(csv_file, usecols=usecols, dtype=str, engine=CSV_ENGINE)
+
+
+def RIS_Input (data):
+    """Accepts RIS text/streams or an already parsed (DataFrame, diagnostics) pair."""
+    if isinstance(data, tuple):
+        return data
+    return RIS_Parse(data)
+
+
+def Split_Trial_Records (df, flag_column, trial_flag):
+    """Splits a parsed RIS frame into (trials, non-trials) with one boolean mask.
+
+    flag_column is normalised in place (stripped, lower-cased) and compared
+    with trial_flag; both partitions keep the original index.
+    """
+    df[flag_column] = df[flag_column].str.strip().str.lower()
+    trial_mask = (df[flag_column] == trial_flag).to_numpy()
+    return df[trial_mask], df[~trial_mask]
+
+
+def Tidy_Embase_Trials (df):
+    """Resets the index, keeps the first of several "; " joined URLs and drops the trailing '/' from Year."""
+    df = df.reset_index(drop=True)
+    df['URL'] = df['URL'].str.split("; ", n=1).str[0]
+    df['Year'] = df['Year'].str.rstrip('//')
+    return df
+
+
+def CENTRAL_Records (data):
+    """Parses CENTRAL RIS data into (trials, non-trials, diagnostics).
+
+    Trials are the "Trial registry record" entries; either partition is None
+    when it has no rows.
+    """
+    df, diagnostics = RIS_Input (data)
+    trials, non_trials = Split_Trial_Records (df, 'Note', "trial registry record")
+    return (trials if len(trials) else None), (non_trials if len(non_trials) else None), diagnostics
+
+
+def Embase_Records (data):
+    """Parses Embase RIS data into (trials, non-trials, diagnostics); trials come from Embase Clinical Trials."""
+    df, diagnostics = RIS_Input (data)
+    trials, non_trials = Split_Trial_Records (df, 'Database', "embase clinical trials")
+    trials = Tidy_Embase_Trials (trials) if len(trials) else None
+    return trials, (non_trials if len(non_trials) else None), diagnostics
+
+
+def WHO_ICTRP_Records (df):
+    df['TrialID'] = df['TrialID'].str.strip()
+    return df
@@ -0,0 +1,214 @@
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+from record_parsers import (RIS_Parse, ICTRP_XML_To_DataFrame, CSV_To_DataFrame, new_RIS_Diagnostics,
+                            CT_GOV_COLUMNS, SCANMEDICINE_COLUMNS)
+
+# Kept for the life of the server so reruns don't pay the worker start-up again.
+# Workers are forked from a fork server that has imported record_parsers:
+# forking the multi-threaded Streamlit server itself can deadlock on locks its
+# other threads hold. Where there is no fork server, files are read on threads.
+_process_pool = None
+_process_pool_lock = threading.Lock()
+_HAS_FORKSERVER = 'forkserver' in multiprocessing.get_all_start_methods()
+# files of one read in flight at once, so one upload cannot hold every worker of the shared pool
+MAX_WORKERS_PER_READ = max(1, (os.cpu_count() or 1) // 2)
+
+
+class FileReadError(Exception):
+    """A file could not be parsed; file_name says which one."""
+    def __init__(self, file_name, error):
+        super().__init__(f"Error reading {file_name}: {error}")
+        self.file_name = file_name
+        self.error = error
+
+
+if _HAS_FORKSERVER:
+    from multiprocessing import forkserver, popen_forkserver, reduction, spawn, util
+    from multiprocessing.context import ForkServerContext, ForkServerProcess, set_spawning_popen
+
+    class _WorkerPopen(popen_forkserver.Popen):
+        """popen_forkserver.Popen, but the worker is not told to import the parent's __main__.
+
+        Streamlit installs the app script as __main__ (per session, on
+        the session's thread), and a worker that imported it would run
+        the app again; read_uploaded_file needs nothing from it.
+        """
+        def _launch(self, process_obj):
+            prep_data = spawn.get_preparation_data(process_obj._name)
+            prep_data.pop('init_main_from_path', None)
+            prep_data.pop('init_main_from_name', None)
+            buf = io.BytesIO()
+            set_spawning_popen(self)
+            try:
+                reduction.dump(prep_data, buf)
+                reduction.dump(process_obj, buf)
+            finally:
+                set_spawning_popen(None)
+
+            self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+            _parent_w = os.dup(w)
+            self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+            with open(w, 'wb', closefd=True) as f:
+                f.write(buf.getbuffer())
+            self.pid = forkserver.read_signed(self.sentinel)
+
+    class _WorkerProcess(ForkServerProcess):
+        @staticmethod
+        def _Popen(process_obj):
+            return _WorkerPopen(process_obj)
+
+    class _WorkerContext(ForkServerContext):
+        Process = _WorkerProcess
+
+    _WORKER_CONTEXT = _WorkerContext()
+    _WORKER_CONTEXT.set_forkserver_preload(['record_parsers'])
+
+
+def _submit_to_process_pool(fn, *args):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_WORKER_CONTEXT)
+        return _process_pool.submit(fn, *args)
+
+
+def _discard_process_pool():
+    # a worker died (e.g. out of memory); the pool is shut down and a fresh one started next time
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+
+def read_uploaded_file(file, file_name, data_type):
+    """Parses one uploaded file (file object or raw bytes) into (DataFrame, RIS diagnostics or None).
+
+    Module level so it can run in a worker process.
+    """
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    if data_type == 'csv':
+        return pd.read_csv(file), None
+    elif data_type == 'ct_csv':
+        return CSV_To_DataFrame(file, CT_GOV_COLUMNS, 'ClinicalTrials.gov'), None
+    elif data_type == 'scanmedicine_csv':
+        return CSV_To_DataFrame(file, SCANMEDICINE_COLUMNS, 'ScanMedicine'), None
+    elif data_type == 'xml':
+        return pd.read_xml(file,parser='etree'), None
+    elif data_type == 'ictrp_xml':
+        return ICTRP_XML_To_DataFrame(file), None
+    elif data_type == 'ris_records':
+        df, diagnostics = RIS_Parse(file.read().decode("utf-8"))
+        df['File_Name'] = file_name
+        return df, diagnostics
+    raise ValueError(f"Unknown data type: {data_type}")
+
+
+def _file_bytes(file):
+    # uploads have getvalue(); plain files opened with open(path, 'rb') are read
+    return file.getvalue() if hasattr(file, 'getvalue') else file.read()
+
+
+def _read_files_in_parallel(files, data_type, progress=None):
+    """Parses the files on a pool, calling progress(done, total) as each one finishes; keeps input order.
+
+    At most MAX_WORKERS_PER_READ files are queued at once.
+    """
+    results = [None] * len(files)
+    if data_type.endswith('csv') or not _HAS_FORKSERVER:
+        # pandas' CSV reader is mostly I/O and releases the GIL, threads are enough
+        executor = ThreadPoolExecutor(max_workers=min(len(files), MAX_WORKERS_PER_READ))
+        submit = lambda file: executor.submit(read_uploaded_file, file, file.name, data_type)
+    else:
+        executor = None
+        submit = lambda file: _submit_to_process_pool(read_uploaded_file, _file_bytes(file), file.name, data_type)
+    pending = {}
+    next_idx = 0
+    done = 0
+    try:
+        while done < len(files):
+            while next_idx < len(files) and len(pending) < MAX_WORKERS_PER_READ:
+                pending[submit(files[next_idx])] = next_idx
+                next_idx += 1
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                idx = pending.pop(future)
+                try:
+                    results[idx] = future.result()
+                except BrokenProcessPool as e:
+                    _discard_process_pool()
+                    raise FileReadError(files[idx].name, e) from e
+                except Exception as e:
+                    for other in pending:
+                        other.cancel()
+                    raise FileReadError(files[idx].name, e) from e
+                done += 1
+                if progress is not None:
+                    progress(done, len(files))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+    return results
+
+
+def read_files(files, data_type, parallel=False, progress=None): #data type could be csv, ct_csv, scanmedicine_csv, xml, ictrp_xml, ris or ris_records
+    """Reads and concatenates a list of CSV, XML or RIS files (uploads or open binary files).
+
+    'ris' returns the joined RIS text. 'ris_records' never builds that text:
+    each file is parsed on its own and the frames are merged into one
+    (DataFrame, diagnostics) pair, with the source file kept in 'File_Name'.
+    'ictrp_xml', 'ct_csv' and 'scanmedicine_csv' read only the fields the app uses.
+    With parallel=True several files are parsed at once (threads for CSV,
+    worker processes for XML and RIS where there is a fork server).
+    Returns None for no files and raises FileReadError when a file cannot
+    be parsed.
+    """
+    if not files:
+        return None
+    if data_type == 'ris':
+        ris_parts = []
+        for file in files:
+            try:
+                # Read the content of the file, joined once after the loop
+                ris_parts.append(file.read().decode("utf-8"))
+            except Exception as e:
+                raise FileReadError(file.name, e) from e
+        return "\n".join(ris_parts + [""])
+    if parallel and len(files) > 1:
+        results = _read_files_in_parallel(files, data_type, progress)
+    else:
+        results = []
+        for file in files:
+            try:
+                results.append(read_uploaded_file(file, file.name, data_type))
+            except Exception as e:
+                raise FileReadError(file.name, e) from e
+
+    all_dfs = []
+    diagnostics = new_RIS_Diagnostics()
+    for df, file_diagnostics in results:
+        all_dfs.append(df)
+        if file_diagnostics is not None:
+            merge_RIS_Diagnostics(diagnostics, file_diagnostics)
+    concatenated_df = pd.concat(all_dfs, ignore_index=True)
+    if data_type == 'ris_records':
+        # a tag missing from some files leaves NaN behind; use None like a single parse does
+        nan_cols = [col for col in concatenated_df.columns
+                    if concatenated_df[col].dtype == object and any(df[col].dtype != object for df in all_dfs)]
+        concatenated_df[nan_cols] = concatenated_df[nan_cols].where(pd.notna, None)
+        return concatenated_df, diagnostics
+    return concatenated_df
+
+
+def merge_RIS_Diagnostics(diagnostics, file_diagnostics):
+    """Adds one file's RIS diagnostics into the running totals."""
+    for key in ('record_count', 'unterminated_records', 'untagged_lines'):
+        diagnostics[key] += file_diagnostics[key]
+    for tag, count in file_diagnostics['unmapped_tags'].items():
+        diagnostics['unmapped_tags'][tag] = diagnostics['unmapped_tags'].get(tag, 0) + count
@@ -0,0 +1,175 @@
+import re
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa  # optional: RE2 picks out the rows worth scanning
+    import pyarrow.compute as pc
+    ID_PREFILTER_ENGINE = 'pyarrow'
+except ImportError:
+    ID_PREFILTER_ENGINE = None
+
+# Columns of the unified frame that can mention a trial's registry IDs
+ID_TEXT_COLUMNS = ['Trial_ID', 'URL', 'Note', 'Abstract']
+
+# One alternative per registry, each a named group whose name is the prefix of
+# the normalised ID. The registry prefix may be followed by spaces, hyphens,
+# colons, '#' or '/'; ICTRP's wrappers (JPRN-, EUCTR...-GB) are matched through.
+# Every alternative starts with its registry's name, or with the number itself
+# for EU CT numbers, which is what _anchor_positions looks for.
+_SEP = r'[\s\-:#/]{0,3}'
+_START = r'(?<![A-Za-z0-9])'
+REGISTRY_ID_PATTERNS = {
+    'NCT': _START + r'NCT' + _SEP + r'(?P<NCT>\d{8})(?!\d)',
+    'ISRCTN': _START + r'ISRCTN' + _SEP + r'(?P<ISRCTN>\d{8})(?!\d)',
+    # EU CTR (CTIS) numbers: 2022-500001-11-00
+    'EUCT': r'(?<![\d\-])(?P<EUCT>\d{4}-5\d{5}-\d{2}-\d{2})(?!\d)',
+    # a bare dddd-dddddd-dd is too common to trust, so the EudraCT number needs its name
+    # ("EUCTR2004-000123-45-GB", "EudraCT No. 2004-000123-45"); the country suffix is dropped
+    'EUDRACT': _START + r'(?:EUCTR|EudraCT)[^0-9\0]{0,20}?(?P<EUDRACT>\d{4}-\d{6}-\d{2})(?!\d|-\d{2}(?!\d))',
+    'ACTRN': _START + r'ACTRN' + _SEP + r'(?P<ACTRN>\d{14})(?!\d)',
+    'CHICTR': _START + r'ChiCTR' + _SEP + r'(?P<CHICTR>(?:[A-Z]{2,4}[\s\-]?)?\d{8,10})(?!\d)',
+    'CTRI': _START + r'CTRI' + _SEP + r'(?P<CTRI>\d{4}[/\-\s]\d{2,3}[/\-\s]\d{4,6})(?!\d)',
+    'DRKS': _START + r'DRKS' + _SEP + r'(?P<DRKS>\d{8})(?!\d)',
+    'UMIN': _START + r'UMIN' + _SEP + r'(?:CTR' + _SEP + r')?(?P<UMIN>\d{9})(?!\d)',
+    'JRCT': _START + r'jRCT' + _SEP + r'(?P<JRCT>[a-z]?\d{9,10})(?!\d)',
+    'JAPICCTI': _START + r'JapicCTI' + _SEP + r'(?P<JAPICCTI>\d{6})(?!\d)',
+    'JMA': _START + r'JMA' + _SEP + r'(?P<JMA>IIA\d{5})(?!\d)',
+    'IRCT': _START + r'IRCT' + _SEP + r'(?P<IRCT>\d{10,14}N\d{1,3})(?![\dA-Za-z])',
+    'KCT': _START + r'KCT' + _SEP + r'(?P<KCT>\d{7})(?!\d)',
+    'PACTR': _START + r'PACTR' + _SEP + r'(?P<PACTR>\d{15})(?!\d)',
+    'TCTR': _START + r'TCTR' + _SEP + r'(?P<TCTR>\d{11})(?!\d)',
+    'NTR': _START + r'(?-i:NTR)' + _SEP + r'(?P<NTR>\d{3,4})(?!\d)',
+    'NL': _START + r'(?-i:NL)(?:-OMON)?(?P<NL>\d{4,6})(?!\d)',
+    'SLCTR': _START + r'SLCTR' + _SEP + r'(?P<SLCTR>\d{4}[/\-]\d{3})(?!\d)',
+    'RBR': _START + r'RBR[\s\-](?P<RBR>[0-9a-z]{6,8})(?![0-9a-z])',
+    'RPCEC': _START + r'RPCEC' + _SEP + r'(?P<RPCEC>\d{8})(?!\d)',
+    'PER': _START + r'PER-(?P<PER>\d{3}-\d{2})(?!\d)',
+    'LBCTR': _START + r'LBCTR' + _SEP + r'(?P<LBCTR>\d{10})(?!\d)',
+    'ITMCTR': _START + r'ITMCTR' + _SEP + r'(?P<ITMCTR>\d{10,12})(?!\d)',
+}
+REGISTRY_ID_PATTERN = re.compile('|'.join(REGISTRY_ID_PATTERNS.values()), re.IGNORECASE)
+
+# RE2 (no look-arounds) pattern matching every string REGISTRY_ID_PATTERN can match in, and few others
+REGISTRY_ID_PREFILTER = (
+    r'(?i:(?:NCT|ISRCTN|ACTRN|CTRI|DRKS|JapicCTI|IRCT|KCT|PACTR|TCTR|NTR|SLCTR|RPCEC|PER|LBCTR|ITMCTR)[\s\-:#/]{0,3}\d'
+    r'|ChiCTR|jRCT|JMA|RBR|UMIN|EUCTR|EudraCT)'
+    r'|NL(?:-OMON)?\d{4}'
+    r'|\d{4}-5\d{5}-\d{2}-\d{2}')
+
+# where a match can begin: the registry names (found in the lower-cased text, or as written
+# for the case-sensitive NTR and NL) and the start of an EU CT number
+_ANCHORS = ['nct', 'isrctn', 'euctr', 'eudract', 'actrn', 'chictr', 'ctri', 'drks', 'umin', 'jrct', 'japiccti',
+            'jma', 'irct', 'kct', 'pactr', 'tctr', 'slctr', 'rbr', 'rpcec', 'per-', 'lbctr', 'itmctr']
+_CASED_ANCHORS = ['NTR', 'NL']
+_EUCT_ANCHOR = re.compile(r'(?<![\d\-])\d{4}-5')
+
+# how the captured number is written in the normalised ID
+_SEPARATOR_RUN = re.compile(r'[\s\-/]+')
+_NUMBER_SEPARATORS = {'CHICTR': '-', 'CTRI': '/', 'SLCTR': '/'}
+_PREFIX_SEPARATORS = {'CTRI': '/', 'SLCTR': '/', 'RBR': '-', 'PER': '-', 'JAPICCTI': '-', 'JMA': '-'}
+
+# about 1 MB of text per regex pass
+EXTRACT_CHUNK_CHARS = 1 << 20
+
+
+def normalize_registry_id(registry, number):
+    """Canonical form of one match: upper case, the registry's prefix and its own separators."""
+    number = number.upper()
+    if registry in _NUMBER_SEPARATORS:
+        number = _SEPARATOR_RUN.sub(_NUMBER_SEPARATORS[registry], number)
+        if registry == 'CHICTR' and number[:1].isalpha():
+            # ChiCTR-TRC-12002345 keeps its hyphens, ChiCTR2000012345 has none
+            return f"CHICTR-{number}"
+    return registry + _PREFIX_SEPARATORS.get(registry, '') + number
+
+
+def _iter_text_chunks(values):
+    # yields (first row, joined text, start offset of each row) for runs of about EXTRACT_CHUNK_CHARS;
+    # rows are joined with NUL, which no pattern (not even _SEP's \s) can match across
+    start = 0
+    while start < len(values):
+        size = 0
+        end = start
+        while end < len(values) and (size < EXTRACT_CHUNK_CHARS or end == start):
+            size += len(values[end]) + 1
+            end += 1
+        chunk = values[start:end]
+        offsets = np.cumsum([0] + [len(text) + 1 for text in chunk[:-1]])
+        yield start, '\0'.join(chunk), offsets
+        start = end
+
+
+def _find_all(text, literal):
+    position = text.find(literal)
+    while position != -1:
+        yield position
+        position = text.find(literal, position + 1)
+
+
+def _anchor_positions(text):
+    # sorted positions where a match may start, or None when lower-casing moves characters
+    folded = text.lower()
+    if len(folded) != len(text):
+        return None
+    positions = [position for literal in _ANCHORS for position in _find_all(folded, literal)]
+    positions += [position for literal in _CASED_ANCHORS for position in _find_all(text, literal)]
+    positions += [match.start() for match in _EUCT_ANCHOR.finditer(text)]
+    return sorted(set(positions))
+
+
+def _iter_matches(text):
+    # REGISTRY_ID_PATTERN.finditer(text), trying the pattern only where a match can begin:
+    # str.find runs at memory speed, while the alternation is slow to try at every character
+    positions = _anchor_positions(text)
+    if positions is None:
+        yield from REGISTRY_ID_PATTERN.finditer(text)
+        return
+    end = 0
+    for position in positions:
+        if position < end:
+            continue
+        match = REGISTRY_ID_PATTERN.match(text, position)
+        if match is not None:
+            end = match.end()
+            yield match
+
+
+def _rows_with_ids(values):
+    # positions of the values that may hold an ID; with pyarrow one RE2 pass over the
+    # column rules out the rest, otherwise every value is scanned
+    if ID_PREFILTER_ENGINE == 'pyarrow':
+        may_match = pc.match_substring_regex(pa.array(values.to_numpy(), type=pa.large_string()), REGISTRY_ID_PREFILTER)
+        return np.flatnonzero(may_match.to_numpy(zero_copy_only=False))
+    return np.arange(len(values))
+
+
+def extract_registry_ids(df, columns=ID_TEXT_COLUMNS):
+    """Every registry ID mentioned in the given columns, as a frame of (Row, Registry_ID).
+
+    Row is the record's position in df. Each column is first narrowed to the
+    values REGISTRY_ID_PREFILTER finds (when pyarrow is installed), then
+    joined into large strings and scanned with the one compiled
+    REGISTRY_ID_PATTERN, so no per-row regex call is made; match offsets are
+    mapped back to rows with a binary search. IDs are normalised (normalize_registry_id, e.g.
+    NCT01234567, EUDRACT2004-000123-45, CTRI/2010/091/000123) and each
+    (Row, Registry_ID) pair appears once.
+    """
+    rows = []
+    registry_ids = []
+    for column in columns:
+        if column not in df.columns:
+            continue
+        values = df[column].fillna('').astype(str)
+        candidate_rows = _rows_with_ids(values)
+        values = values.to_numpy()[candidate_rows].tolist()
+        for first_value, text, offsets in _iter_text_chunks(values):
+            positions = []
+            for match in _iter_matches(text):
+                registry = match.lastgroup
+                positions.append(match.start())
+                registry_ids.append(normalize_registry_id(registry, match.group(registry)))
+            rows.append(candidate_rows[first_value + np.searchsorted(offsets, positions, side='right') - 1])
+    found = pd.DataFrame({'Row': np.concatenate(rows).astype(np.int64) if rows else np.empty(0, dtype=np.int64),
+                          'Registry_ID': pd.Series(registry_ids, dtype=object)})
+    return found.drop_duplicates(ignore_index=True)
@@ -0,0 +1,22 @@
+import pandas as pd
+from unified_schema import Match_Keys, Title_Year_Groups
+
+
+def _groups(years, year_tolerance):
+    records = pd.DataFrame({'Title': ['Drug X for anxiety'] * len(years), 'Year': years})
+    groups = Title_Year_Groups(Match_Keys(records), year_tolerance)
+    # group numbers follow the sort order, so compare them by first appearance
+    return pd.factorize(groups)[0].tolist()
+
+
+def test_neighbouring_years_share_a_group():
+    assert _groups(['2018', '2019', '2020'], 1) == [0, 0, 0]
+
+
+def test_groups_do_not_depend_on_other_records():
+    assert _groups(['2019', '2020'], 1) == [0, 0]
+    assert _groups(['2018', '2020'], 1) == [0, 1]
+
+
+def test_exact_years_without_tolerance():
+    assert _groups(['2018', '2019', '2018', None], 0) == [0, 1, 0, 2]
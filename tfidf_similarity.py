@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from unified_schema import Title_Keys
+from fuzzy_titles import record_years, years_within, Pair_Candidates, YEAR_TOLERANCE
+
+# Records are compared on TF-IDF vectors of their title words (and, optionally,
+# of the abstracts the registry parsers assemble). The sparse products are
+# taken a block of records at a time through an inverted index, so only
+# records sharing a word are ever scored and no n x n matrix is built; each
+# record keeps its TOP_K best neighbours.
+TOP_K = 5
+TFIDF_THRESHOLD = 0.6
+# words found in more than this share of the records (trial, study, ...) are dropped, as sklearn's
+# max_df; small sets keep words held by up to COMMON_WORD_RECORDS records
+MAX_DOCUMENT_FREQUENCY = 0.05
+COMMON_WORD_RECORDS = 1000
+ABSTRACT_WEIGHT = 0.5
+# the Abstract of these sources is built from labelled registry fields (INTERVENTION:, CONDITION:, ...)
+SYNTHESIZED_ABSTRACT_DATABASES = ['WHO_ICTRP', 'ScanMedicine']
+# partial products held in memory at once
+BLOCK_PRODUCTS = 1 << 21
+
+
+def _word_entries(texts):
+    # (record position, word) for every word of every text, folded as the Title/Year table's titles
+    words = Title_Keys(texts).str.split().explode()
+    words = words[words.notna() & (words != '')]
+    return words.index.to_numpy(dtype=np.int64), words.to_numpy()
+
+
+def tfidf_matrix(records_df, use_abstracts=False, max_document_frequency=MAX_DOCUMENT_FREQUENCY):
+    """Sparse L2-normalised TF-IDF vectors of the records, as COO triplets sorted by record.
+
+    Returns (rows, terms, weights, n_terms). Term frequencies are sublinear
+    (1 + log tf) and idf is smoothed, log((1 + n) / (1 + df)) + 1. With
+    use_abstracts the words of the synthesized ICTRP/ScanMedicine abstracts
+    are added as separate terms weighted by ABSTRACT_WEIGHT.
+    """
+    n_records = len(records_df)
+    rows, words = _word_entries(records_df['Title'].reset_index(drop=True))
+    fields = [(rows, words, 1.0)]
+    if use_abstracts and 'Abstract' in records_df.columns:
+        abstracts = records_df['Abstract'].reset_index(drop=True)
+        synthesized = records_df['Database'].isin(SYNTHESIZED_ABSTRACT_DATABASES).to_numpy()
+        rows, words = _word_entries(abstracts[synthesized])
+        fields.append((rows, words, ABSTRACT_WEIGHT))
+
+    all_rows, all_terms, all_weights = [], [], []
+    n_terms = 0
+    for rows, words, field_weight in fields:
+        terms, vocabulary = pd.factorize(words)
+        # term frequency per (record, term)
+        keys, counts = np.unique(rows * len(vocabulary) + terms, return_counts=True)
+        rows, terms = keys // max(len(vocabulary), 1), keys % max(len(vocabulary), 1)
+        document_frequency = np.bincount(terms, minlength=len(vocabulary))
+        idf = np.log((1 + n_records) / (1 + document_frequency)) + 1
+        keep = document_frequency[terms] <= max(COMMON_WORD_RECORDS, max_document_frequency * n_records)
+        all_rows.append(rows[keep])
+        all_terms.append(terms[keep] + n_terms)
+        all_weights.append(field_weight * (1 + np.log(counts[keep])) * idf[terms[keep]])
+        n_terms += len(vocabulary)
+    rows, terms, weights = np.concatenate(all_rows), np.concatenate(all_terms), np.concatenate(all_weights)
+    order = np.argsort(rows, kind='stable')
+    rows, terms, weights = rows[order], terms[order], weights[order]
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=n_records))
+    return rows, terms, weights / norms[rows], n_terms
+
+
+def top_k_neighbours(rows, terms, weights, n_records, n_terms, k=TOP_K, threshold=TFIDF_THRESHOLD,
+                     years=None, year_tolerance=None):
+    """The k most similar other records of each record, by cosine of the TF-IDF vectors.
+
+    Products are computed through an inverted index (term -> records), a block
+    of records at a time so at most about BLOCK_PRODUCTS partial products are
+    held at once. Returns (left, right, similarity) arrays; neighbours below
+    threshold, or more than year_tolerance years apart when years are given,
+    are left out before the k best are picked.
+    """
+    # inverted index, records in order within each term; cosine is symmetric, so each
+    # (record, term) entry is only multiplied with the later records holding the term
+    by_term = np.argsort(terms, kind='stable')
+    posting_rows, posting_weights = rows[by_term], weights[by_term]
+    term_start = np.searchsorted(terms[by_term], np.arange(n_terms + 1))
+    position = np.empty(len(rows), dtype=np.int64)
+    position[by_term] = np.arange(len(rows))
+    products = term_start[terms + 1] - position - 1
+
+    record_start = np.searchsorted(rows, np.arange(n_records + 1))
+    record_products = np.add.reduceat(np.r_[products, 0], record_start[:-1]) if len(rows) else np.zeros(n_records, dtype=np.int64)
+    record_products[np.diff(record_start) == 0] = 0
+    cumulative = np.cumsum(record_products)
+
+    lefts, rights, similarities = [], [], []
+    first = 0
+    while first < n_records:
+        # the next block ends where its partial products would pass BLOCK_PRODUCTS (at least one record)
+        done = cumulative[first - 1] if first else 0
+        last = max(int(np.searchsorted(cumulative, done + BLOCK_PRODUCTS, side='right')), first + 1)
+        entries = slice(record_start[first], record_start[last])
+        first_record = first
+        first = last
+        counts = products[entries]
+        total = int(counts.sum())
+        if not total:
+            continue
+        # expand every (record, term) entry over the term's postings
+        offsets = np.repeat(position[entries] + 1 - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(total)
+        keys = np.repeat(rows[entries] - first_record, counts) * n_records + posting_rows[offsets]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        similarity = np.bincount(inverse, weights=np.repeat(weights[entries], counts) * posting_weights[offsets])
+        keep = similarity >= threshold
+        left, right = keys[keep] // n_records + first_record, keys[keep] % n_records
+        similarity = similarity[keep]
+        if years is not None and year_tolerance is not None:
+            near = years_within(years[left], years[right], year_tolerance)
+            left, right, similarity = left[near], right[near], similarity[near]
+        lefts.append(left)
+        rights.append(right)
+        similarities.append(similarity)
+    if not lefts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    # each pair counts towards the top k of both its records
+    left = np.concatenate(lefts + rights)
+    right = np.concatenate(rights + lefts)
+    similarity = np.minimum(np.concatenate(similarities + similarities), 1.0)
+    order = np.lexsort((right, -similarity, left))
+    left, right, similarity = left[order], right[order], similarity[order]
+    group_start = np.flatnonzero(np.r_[True, left[1:] != left[:-1]])
+    rank = np.arange(len(left)) - np.repeat(group_start, np.diff(np.r_[group_start, len(left)]))
+    top = rank < k
+    return left[top], right[top], similarity[top]
+
+
+def tfidf_similar_pairs(records_df, threshold=TFIDF_THRESHOLD, year_tolerance=YEAR_TOLERANCE, k=TOP_K,
+                        use_abstracts=False):
+    """Ranked candidate pairs: each record's top-k TF-IDF neighbours at or above threshold.
+
+    Pairs must also be within year_tolerance years (None skips the year
+    check; see years_within for missing years). Records whose Title_Keys are
+    identical are always paired, with Similarity 1, even when all their words
+    are too common to be indexed. A pair found from both sides is listed once.
+    Returns a frame of Left/Right index labels and Similarity, most similar
+    first, like similar_title_pairs.
+    """
+    years = record_years(records_df)
+    rows, terms, weights, n_terms = tfidf_matrix(records_df, use_abstracts)
+    left, right, similarity = top_k_neighbours(rows, terms, weights, len(records_df), n_terms, k, threshold,
+                                               years, year_tolerance)
+    # identical titles (and years, under a tolerance) are chained record to record
+    same = pd.DataFrame({'Title': Title_Keys(records_df['Title']).to_numpy(), 'Year': years})
+    same = same[same['Title'] != '']
+    same = same.sort_values(by=['Title', 'Year'], kind='stable')
+    chained = (same['Title'].to_numpy()[1:] == same['Title'].to_numpy()[:-1])
+    if year_tolerance is not None:
+        chained &= years_within(same['Year'].to_numpy()[1:], same['Year'].to_numpy()[:-1], year_tolerance)
+    positions = same.index.to_numpy()
+    left = np.r_[left, positions[:-1][chained]]
+    right = np.r_[right, positions[1:][chained]]
+    similarity = np.r_[similarity, np.ones(chained.sum())]
+
+    pairs = pd.DataFrame({'Left': np.minimum(left, right), 'Right': np.maximum(left, right), 'Similarity': similarity})
+    pairs = pairs.sort_values(by='Similarity', ascending=False, kind='stable').drop_duplicates(subset=['Left', 'Right'])
+    pairs = pairs.sort_values(by=['Similarity', 'Left', 'Right'], ascending=[False, True, True], kind='stable')
+    return pd.DataFrame({'Left': records_df.index[pairs['Left']], 'Right': records_df.index[pairs['Right']],
+                         'Similarity': pairs['Similarity'].to_numpy()})
+
+
+def TFIDF_Candidates (master_records_df, threshold=TFIDF_THRESHOLD, year_tolerance=YEAR_TOLERANCE, use_abstracts=False):
+    """Master records with a TF-IDF neighbour (see tfidf_similar_pairs), grouped for review by Pair_Candidates."""
+    return Pair_Candidates(master_records_df, tfidf_similar_pairs(master_records_df, threshold, year_tolerance,
+                                                                  use_abstracts=use_abstracts))
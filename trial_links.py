@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+from registry_ids import extract_registry_ids
+from unified_schema import STATUS_DTYPE
+
+
+# Only fields that state a record's own identifiers link records: the Trial_ID,
+# the URL and the secondary-ID list ICTRP and ScanMedicine export (kept at the
+# end of Note, see Secondary_IDs_Note). IDs merely mentioned in an abstract or
+# a note ("compared with NCT...") never link.
+LINK_ID_COLUMNS = ['Trial_ID', 'URL', 'Secondary_IDs']
+SECONDARY_ID_DATABASES = ['WHO_ICTRP', 'ScanMedicine']
+_SECONDARY_IDS = r'(?s)Secondary IDs: (.*)$'
+_REGISTRY = r'^([A-Z]+)'
+
+
+def union_find_components(n_items, left, right, primary_ids=None):
+    """Connected components of the edges (left[k], right[k]) over items 0..n_items-1.
+
+    A disjoint-set forest with union by size and path halving, so the cost is
+    near-linear in the number of edges. primary_ids may map an item to its
+    own IDs, {registry: ID}; an edge that would put two different IDs of one
+    registry in a component is skipped, edges being taken in order. Returns
+    each item's root.
+    """
+    parent = list(range(n_items))
+    size = [1] * n_items
+    primary_ids = dict(primary_ids or {})
+
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+        ids_a, ids_b = primary_ids.get(a), primary_ids.get(b)
+        if ids_a and ids_b and any(ids_a.get(registry, registry_id) != registry_id for registry, registry_id in ids_b.items()):
+            continue
+        if size[a] < size[b]:
+            a, b = b, a
+            ids_a, ids_b = ids_b, ids_a
+        parent[b] = a
+        size[a] += size[b]
+        if ids_b:
+            primary_ids[a] = {**ids_b, **ids_a} if ids_a else ids_b
+    roots = np.arange(n_items)
+    touched = np.unique(np.concatenate([left, right])) if len(left) else np.empty(0, dtype=np.int64)
+    roots[touched] = [find(item) for item in touched.tolist()]
+    return roots
+
+
+def _link_fields(sorted_df):
+    # Trial_ID, URL and the registries' own secondary-ID lists, as columns for extract_registry_ids
+    note = sorted_df['Note'].astype(object).where(sorted_df['Database'].isin(SECONDARY_ID_DATABASES).to_numpy())
+    return pd.DataFrame({'Trial_ID': sorted_df['Trial_ID'].to_numpy(), 'URL': sorted_df['URL'].to_numpy(),
+                         'Secondary_IDs': note.str.extract(_SECONDARY_IDS, expand=False).to_numpy()})
+
+
+def Link_Registry_Records (sorted_df, columns=LINK_ID_COLUMNS):
+    """Relabels Master/Duplicate over clusters of records that share a Trial_ID or a registry ID.
+
+    Registry IDs are taken from the Trial_ID, the URL and the secondary IDs
+    of ICTRP/ScanMedicine records (see LINK_ID_COLUMNS, extract_registry_ids),
+    so an ICTRP record listing an NCT number among its secondary IDs joins
+    that trial's cluster. A cluster never holds two different Trial_IDs of
+    one registry (NCT00000001 and NCT00000002 stay apart whatever links
+    them). Each cluster keeps one Master, the record with the lowest
+    Source_Code (the earlier one on a tie); records without a Trial_ID are
+    never Masters, as before. Rows are returned cluster by cluster with a
+    Link_Group number; without extra links the order and labels are those of
+    Unified_Records.
+    """
+    n_records = len(sorted_df)
+    trial_ids = sorted_df['Trial_ID']
+    has_id = trial_ids.notna().to_numpy()
+    fields = _link_fields(sorted_df)
+    registry_ids = extract_registry_ids(fields, columns)
+    # each record's own IDs, registry by registry, are those found in its Trial_ID
+    own_ids = extract_registry_ids(fields, ['Trial_ID']).drop_duplicates(subset='Row')
+    own_ids['Registry'] = own_ids['Registry_ID'].str.extract(_REGISTRY, expand=False)
+    primary_ids = {}
+    for row, registry, registry_id in own_ids[['Row', 'Registry', 'Registry_ID']].itertuples(index=False, name=None):
+        primary_ids.setdefault(row, {}).setdefault(registry, registry_id)
+    tokens = pd.concat([
+        pd.DataFrame({'Row': np.flatnonzero(has_id), 'Token': 'TRIAL_ID:' + trial_ids[has_id].astype(str).to_numpy()}),
+        registry_ids.rename(columns={'Registry_ID': 'Token'}),
+    ], ignore_index=True)
+    # every record holding a token is linked to the first record holding it
+    first_row = tokens.groupby('Token')['Row'].transform('min').to_numpy()
+    rows = tokens['Row'].to_numpy()
+    linked = first_row != rows
+    roots = union_find_components(n_records, first_row[linked], rows[linked], primary_ids)
+
+    groups = pd.factorize(roots)[0]
+    order = np.lexsort((np.arange(n_records), sorted_df['Source_Code'].to_numpy(), ~has_id, groups))
+    linked_df = sorted_df.iloc[order].reset_index(drop=True)
+    groups = groups[order]
+    is_master = np.r_[True, groups[1:] != groups[:-1]] & has_id[order]
+    linked_df['Status'] = pd.Categorical(np.where(is_master, 'Master', 'Duplicate'), dtype=STATUS_DTYPE)
+    linked_df.insert(1, 'Link_Group', groups + 1)
+    return linked_df
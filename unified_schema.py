@@ -0,0 +1,288 @@
+import re
+import pandas as pd
+import numpy as np
+
+UNIFIED_COLUMNS = ['Trial_ID','Author', 'Title', 'Source', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number','Volume','Issue', 'Database','Source_Code']
+SORTED_COLUMNS = ["Status", "Database", "Trial_ID", "Author", "Title", "Source", "Year", "URL", "Abstract", "Keywords", "Note", "Acession_Number", "Volume", "Issue", "Source_Code"]
+
+# The low-cardinality columns are stored as categories (one byte per record) rather than
+# per-record strings; categories are listed in sorted order so sorting and pivot tables are unchanged
+DATABASE_DTYPE = pd.CategoricalDtype(['CENTRAL', 'ClinicalTrialsGov', 'EMBASE', 'ScanMedicine', 'WHO_ICTRP'])
+STATUS_DTYPE = pd.CategoricalDtype(['Duplicate', 'Master'])
+
+# Title keys drop these words, so "A trial of X in Y" and "Trial of X in the Y" share one
+TITLE_STOP_WORDS = ['a', 'an', 'and', 'as', 'at', 'by', 'for', 'from', 'in', 'into', 'of', 'on', 'or', 'the', 'to', 'vs', 'versus', 'with']
+_COMBINING_MARKS = re.compile(r'[\u0300-\u036f]')
+_NON_WORD = re.compile(r'[\W_]+')
+_STOP_WORDS = re.compile(r'(?:^| )(?:' + '|'.join(TITLE_STOP_WORDS) + r')(?= |$)')
+# a year is the first four-digit number standing on its own: 2020-01-15, 15/01/2020, January 2020
+YEAR_PATTERN = r'(?<![0-9])([0-9]{4})(?![0-9])'
+
+
+# Registry exports name the secondary-ID field differently; whichever is present is kept in Note
+SECONDARY_ID_COLUMNS = ['Secondary_ID', 'Secondary_IDs', 'SecondaryIDs', 'SecondaryId']
+
+
+def Secondary_IDs_Note (df):
+    """The ' Secondary IDs: ...' text for each row, or None when the export has no secondary-ID field."""
+    columns = [column for column in SECONDARY_ID_COLUMNS if column in df.columns]
+    if not columns:
+        return None
+    secondary_ids = df[columns[0]].fillna('').astype(str).str.strip()
+    for column in columns[1:]:
+        more = df[column].fillna('').astype(str).str.strip()
+        secondary_ids = secondary_ids.where(more == '', (secondary_ids + '; ' + more).str.lstrip('; '))
+    return (" Secondary IDs: " + secondary_ids).where(secondary_ids != '', '')
+
+
+def Extract_Years (values):
+    """The year (see YEAR_PATTERN) of each value, as a string; NaN where there is none."""
+    return values.astype(str).str.extract(YEAR_PATTERN, expand=False)
+
+
+def CENTRAL_Subset (central):
+    central_subset = central[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number', 'Source','Volume','Issue']].copy()
+    central_subset['Trial_ID'] = central['Author'].str.strip()
+    central_subset['Database'] = 'CENTRAL'
+    central_subset['Source_Code'] = 1
+    return central_subset[UNIFIED_COLUMNS]
+
+
+def Embase_Subset (embase):
+    embase_subset = embase[['Author', 'Title', 'Year', 'URL', 'Abstract','Keywords', 'Note', 'Acession_Number', 'Source','Volume','Issue']].copy()
+    embase_subset['Trial_ID'] = embase['Acession_Number'].str.strip()
+    embase_subset['Database'] = 'EMBASE'
+    embase_subset['Source_Code'] = 2
+    return embase_subset[UNIFIED_COLUMNS]
+
+
+def ClinicalTrialsGov_Subset (ct):
+    ct_subset = ct[['NCT Number']].copy()
+    ct_subset['NCT Number'] = ct_subset['NCT Number'].str.strip()
+    targeted_tags = ['Study Title', 'First Posted', 'Study URL', "Brief Summary", "Primary Outcome Measures","Secondary Outcome Measures", "Study Status"]
+    for tag in targeted_tags:
+        if tag in ct.columns:
+            ct_subset[tag] = ct[tag]
+        else:
+            ct_subset[tag] = ""
+    ct_subset['Note'] = "Study Status: " + ct_subset["Study Status"].fillna('').astype(str) + " " + "OUTCOMS: "+ ct_subset["Primary Outcome Measures"].fillna('').astype(str) + " " + ct_subset["Secondary Outcome Measures"].fillna('').astype(str)
+    # the NCT Number is only kept as Trial_ID; the exports list it as Author and Acession_Number
+    ct_subset['Author'] = None
+    ct_subset['Acession_Number'] = None
+    ct_subset['Keywords'] = ""
+    ct_subset = ct_subset.rename(columns={'NCT Number': 'Trial_ID', 'Study Title': 'Title', "Brief Summary":'Abstract','First Posted':'Year', 'Study URL':'URL'})
+    ct_subset['Year'] = Extract_Years(ct_subset['Year'])
+    ct_subset['Database'] = 'ClinicalTrialsGov'
+    ct_subset['Source_Code'] = 3
+    ct_subset['Source'] = "ClinicalTrials.gov"
+    ct_subset['Volume'] = ""
+    ct_subset['Issue'] = ""
+    return ct_subset[UNIFIED_COLUMNS]
+
+
+def WHO_ICTRP_Subset (ictrp):
+    ictrp_subset = ictrp[['TrialID']].copy()
+    ictrp_subset['TrialID'] = ictrp_subset['TrialID'].str.strip()
+    targeted_tags = ['Public_title', 'Date_registration', 'web_address', "Recruitment_Status", "Condition", "Intervention", "Primary_outcome", "Secondary_outcome", "Inclusion_Criteria", "Countries", "Scientific_title", "Internal_Number"]
+    for tag in targeted_tags:
+        if tag in ictrp.columns:
+            ictrp_subset[tag] = ictrp[tag]
+        else:
+            ictrp_subset[tag] = ""
+    ictrp_subset['Abstract'] = 'INTERVENTION: '+ ictrp_subset['Intervention'].fillna('').astype(str) + ' CONDITION: ' + ictrp_subset['Condition'].fillna('').astype(str) + " PRIMARY OUTCOME: " + ictrp_subset['Primary_outcome'].fillna('').astype(str) + " SECONDARY OUTCOME: " + ictrp_subset['Secondary_outcome'].fillna('').astype(str) + " INCLUSION CRITERIA: " + ictrp_subset['Inclusion_Criteria'].fillna('').astype(str)
+    ictrp_subset['Note'] = "Scientific title: " + ictrp_subset["Scientific_title"].fillna('').astype(str) + " Recruitment_Status:" +  ictrp_subset["Recruitment_Status"].fillna('').astype(str) + " Country: " + ictrp_subset["Countries"].fillna('').astype(str)
+    secondary_ids = Secondary_IDs_Note(ictrp)
+    if secondary_ids is not None:
+        ictrp_subset['Note'] += secondary_ids
+    ictrp_subset['Keywords'] = ""
+    ictrp_subset['Author'] = None
+    ictrp_subset['Acession_Number'] = ictrp_subset['Internal_Number']
+    ictrp_subset = ictrp_subset.rename(columns={'TrialID': 'Trial_ID', 'Public_title': 'Title', 'Date_registration':'Year', 'web_address':'URL'})
+    ictrp_subset['Year'] = Extract_Years(ictrp_subset['Year'])
+    ictrp_subset['Database'] = 'WHO_ICTRP'
+    ictrp_subset['Source'] = "WHO ICTRP"
+    ictrp_subset['Volume'] = ""
+    ictrp_subset['Issue'] = ""
+    ictrp_subset['Source_Code'] = 4
+    return ictrp_subset[UNIFIED_COLUMNS]
+
+
+def ScanMedicine_Subset (scanmedicine):
+    scanmedicine_subset = scanmedicine[['MainID']].copy()
+    scanmedicine_subset['MainID'] = scanmedicine_subset['MainID'].str.strip()
+    targeted_tags = ['PublicTitle', 'DateOfRegistration', 'DocURL', "TrialStatus", "HealthConditionOrProblemStudied", "Interventions", "PrimaryOutcomes", "InclusionCriteria", "SecondaryOutcomes", "CountriesOfRecruitment", "ScientificTitle"]
+    for tag in targeted_tags:
+        if tag in scanmedicine.columns:
+            scanmedicine_subset[tag] = scanmedicine[tag]
+        else:
+            scanmedicine_subset[tag] = ""
+
+    scanmedicine_subset['Abstract'] = 'INTERVENTION: '+ scanmedicine_subset['Interventions'].fillna('').astype(str) + ' CONDITION: ' + scanmedicine_subset['HealthConditionOrProblemStudied'].fillna('').astype(str) + " PRIMARY OUTCOME: " + scanmedicine_subset['PrimaryOutcomes'].fillna('').astype(str) + " SECONDARY OUTCOME: " + scanmedicine_subset['SecondaryOutcomes'].fillna('').astype(str) + " INCLUSION CRITERIA: " + scanmedicine_subset['InclusionCriteria'].fillna('').astype(str)
+    scanmedicine_subset['Note'] = "Scientific title: " + scanmedicine_subset["ScientificTitle"].fillna('').astype(str) + " TrialStatus:" +  scanmedicine_subset["TrialStatus"].fillna('').astype(str) + " Country: " + scanmedicine_subset["CountriesOfRecruitment"].fillna('').astype(str)
+    secondary_ids = Secondary_IDs_Note(scanmedicine)
+    if secondary_ids is not None:
+        scanmedicine_subset['Note'] += secondary_ids
+    scanmedicine_subset['Keywords'] = ""
+    scanmedicine_subset['Author'] = None
+    scanmedicine_subset['Acession_Number'] = None
+    scanmedicine_subset = scanmedicine_subset.rename(columns={'MainID': 'Trial_ID', 'PublicTitle': 'Title', 'DateOfRegistration':'Year', 'DocURL':'URL'})
+    scanmedicine_subset['Year'] = Extract_Years(scanmedicine_subset['Year'])
+    scanmedicine_subset['Database'] = 'ScanMedicine'
+    scanmedicine_subset['Source'] = 'ScanMedicine'
+    scanmedicine_subset['Volume'] = ""
+    scanmedicine_subset['Issue'] = ""
+    scanmedicine_subset['Source_Code'] = 5
+    return scanmedicine_subset[UNIFIED_COLUMNS]
+
+
+def Unified_Records (central=None, embase=None, ct=None, ictrp=None, scanmedicine=None, ordered=True):
+    """Builds the combined frame of all trial records with Master/Duplicate status.
+
+    The first record of each Trial_ID by Source_Code is the Master (see
+    Master_Status). With ordered=False the records stay in source order and
+    no sort is done; otherwise they are sorted by Trial_ID and Source_Code.
+    Low-cardinality columns get compact dtypes (see Compact_Records). Returns
+    None when no source has data.
+    """
+    dfs = []
+    if isinstance(central, pd.DataFrame):
+        dfs.append (CENTRAL_Subset(central))
+    if isinstance(embase, pd.DataFrame):
+        dfs.append (Embase_Subset(embase))
+    if isinstance(ct, pd.DataFrame):
+        dfs.append (ClinicalTrialsGov_Subset(ct))
+    if isinstance(ictrp, pd.DataFrame):
+        dfs.append (WHO_ICTRP_Subset(ictrp))
+    if isinstance(scanmedicine, pd.DataFrame):
+        dfs.append(ScanMedicine_Subset(scanmedicine))
+    if not dfs:
+        return None
+    combined_df = pd.concat(dfs, ignore_index=True)
+    combined_df['Status'] = Master_Status(combined_df)
+    combined_df = Compact_Records(combined_df)
+    if not ordered:
+        return combined_df[SORTED_COLUMNS]
+    return Order_Records(combined_df)[SORTED_COLUMNS]
+
+
+def Compact_Records (records_df):
+    """Gives the unified columns their compact dtypes, in place, and returns the frame.
+
+    Database and Status become categoricals with fixed categories, Source a
+    categorical of the journals/registries present and Source_Code an int8.
+    """
+    records_df['Database'] = records_df['Database'].astype(DATABASE_DTYPE)
+    records_df['Source'] = records_df['Source'].astype('category')
+    records_df['Source_Code'] = records_df['Source_Code'].astype(np.int8)
+    if 'Status' in records_df.columns:
+        records_df['Status'] = records_df['Status'].astype(STATUS_DTYPE)
+    return records_df
+
+
+def Master_Status (records_df):
+    """'Master' or 'Duplicate' for each record, without sorting the frame.
+
+    Trial_IDs are hashed to integer codes and each code keeps the record with
+    the lowest Source_Code, the earliest one on a tie: the first of its
+    Trial_ID in Order_Records. Records without a Trial_ID are Duplicates.
+    """
+    codes = pd.factorize(records_df['Trial_ID'])[0]
+    has_id = codes >= 0
+    # Source_Code, then position, packed into one key so a single minimum per code decides
+    n_records = len(records_df)
+    keys = records_df['Source_Code'].to_numpy(dtype=np.int64) * max(n_records, 1) + np.arange(n_records)
+    lowest = np.full(codes.max() + 1 if has_id.any() else 0, np.iinfo(np.int64).max)
+    np.minimum.at(lowest, codes[has_id], keys[has_id])
+    is_master = np.zeros(n_records, dtype=bool)
+    is_master[has_id] = lowest[codes[has_id]] == keys[has_id]
+    return np.where(is_master, 'Master', 'Duplicate')
+
+
+def Order_Records (records_df):
+    """Records sorted by Trial_ID and Source_Code, the order used for display and export."""
+    return records_df.sort_values(by=['Trial_ID', 'Source_Code'], kind='stable').reset_index(drop=True)
+
+
+def Title_Keys (titles):
+    """Titles Unicode-folded (NFKD, accents dropped, case-folded), with every run of
+    punctuation or whitespace made one space and TITLE_STOP_WORDS removed; missing titles become ''.
+    """
+    titles = titles.fillna('').astype(str).str.normalize('NFKD').str.replace(_COMBINING_MARKS, '', regex=True)
+    titles = titles.str.casefold().str.replace(_NON_WORD, ' ', regex=True).str.replace(_STOP_WORDS, '', regex=True)
+    return titles.str.strip()
+
+
+def Match_Keys (df):
+    """Normalised Title and Year keys that potential duplicates share, and a 64-bit hash of the pair.
+
+    Title_Key is the title as Title_Keys folds it, Year_Key the year of Year
+    (see Extract_Years); missing values become ''. Match_Key (uint64) hashes
+    both and Title_Hash the title alone, so passes can group records on
+    integers; the original fields are left untouched.
+    """
+    keys = pd.DataFrame({'Title_Key': Title_Keys(df['Title']),
+                         'Year_Key': Extract_Years(df['Year']).fillna('')}, index=df.index)
+    keys['Match_Key'] = pd.util.hash_pandas_object(keys[['Title_Key', 'Year_Key']], index=False)
+    keys['Title_Hash'] = pd.util.hash_pandas_object(keys['Title_Key'], index=False)
+    return keys
+
+
+def Title_Year_Groups (match_keys, year_tolerance=0):
+    """Blocking index over Match_Keys: a group number for each record.
+
+    Records are blocked by Title_Hash and, within a block, ordered by year; a
+    record joins the previous one's group when their years are at most
+    year_tolerance apart, so every record is grouped with each record of its
+    title within ±year_tolerance years (2018, 2019 and 2020 are one group at
+    a tolerance of 1), whatever other records exist. Records without a year
+    are grouped only with each other. With year_tolerance 0 the groups are
+    exactly those of Match_Key. One sort of integer keys, then a linear pass:
+    no pairs are enumerated.
+    """
+    years = pd.to_numeric(match_keys['Year_Key'], errors='coerce').to_numpy()
+    has_year = ~np.isnan(years)
+    title_hash = match_keys['Title_Hash'].to_numpy()
+    years = np.where(has_year, years, 0)
+    order = np.lexsort((years, has_year, title_hash))
+    years, has_year, title_hash = years[order], has_year[order], title_hash[order]
+    new_group = np.r_[True, (title_hash[1:] != title_hash[:-1]) | (has_year[1:] != has_year[:-1])
+                      | (np.diff(years) > year_tolerance)]
+    groups = np.empty(len(order), dtype=np.int64)
+    groups[order] = np.cumsum(new_group) - 1
+    return pd.Series(groups, index=match_keys.index)
+
+
+def Title_Year_Candidates (master_records_df, match_keys=None, year_tolerance=0):
+    """Master records that share a Title key, with years chained within year_tolerance, ordered for review.
+
+    Groups come from the Title_Year_Groups blocking index; match_keys may
+    hold keys computed earlier for these records (or more). Each group is
+    listed together, by Source_Code, and the rows keep their original fields.
+    """
+    keys = Match_Keys(master_records_df) if match_keys is None else match_keys.loc[master_records_df.index]
+    keys = keys.assign(Group=Title_Year_Groups(keys, year_tolerance), Source_Code=master_records_df['Source_Code'])
+    keys = keys[keys['Group'].duplicated(keep=False)]
+    keys = keys.sort_values(by=['Title_Key', 'Group', 'Source_Code'], kind='stable')
+    return master_records_df.loc[keys.index]
+
+
+def Review_Clusters (candidates_df, group_keys):
+    """Numbers the candidate groups as review clusters and returns (clusters_df, cluster_starts).
+
+    candidates_df must list each group together, first the record to keep,
+    as Title_Year_Candidates and Similar_Title_Candidates do; group_keys
+    gives each row's group. clusters_df adds Cluster, Members and Suggestion
+    ('Keep' for the first record of a cluster, 'Remove' for the others);
+    cluster_starts holds the row position where each cluster begins and,
+    last, the number of rows, so a page of clusters is one slice.
+    """
+    keys = np.asarray(group_keys)
+    n_rows = len(candidates_df)
+    first = np.r_[True, keys[1:] != keys[:-1]] if n_rows else np.zeros(0, dtype=bool)
+    cluster_starts = np.r_[np.flatnonzero(first), n_rows]
+    members = np.diff(cluster_starts)
+    clusters_df = candidates_df.copy()
+    clusters_df.insert(0, 'Cluster', np.cumsum(first))
+    clusters_df.insert(1, 'Members', np.repeat(members, members))
+    clusters_df.insert(2, 'Suggestion', np.where(first, 'Keep', 'Remove'))
+    return clusters_df, cluster_starts